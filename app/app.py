@@ -1,27 +1,34 @@
 ﻿import os
 import json
+import time
+import asyncio
+import orjson
 import stripe
+from functools import lru_cache
 from typing import Optional, Annotated
 from fastapi import FastAPI, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from sec_api import InsiderTradingApi, FullTextSearchApi, QueryApi
+from sec_api import FullTextSearchApi
 from logsnag import LogSnag
 
 
 # Constants & Types
 from app.internals.types import CheckoutSession, RequestOtp, VerifyOtp
 from app.internals.twilio_helper import send_verifiction_otp, verify_otp, send_message_notification
+from app.internals.sec_helper import InsiderTradingApi, QueryApi
 from app.internals.constants import sort_options, plan_names, USERS_TABLE
 from app.internals.supabase_helper import supabase, get_insider_trades, \
     cancel_email_subscription, get_trades_without_return, \
     update_trades_without_returns, insert_data_into_table, get_recent_trades
-from app.internals.utils import isLifetime, calculate_returns, calculate_amount
+from app.internals.utils import isLifetime, calculate_returns, calculate_amount, \
+    get_object_id
 from app.internals.resend_helper import signal_notification
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 load_dotenv()
 
 # GET ENVS
@@ -33,12 +40,19 @@ LOG_SNAG_PROJECT = os.getenv('LOGSNAG_PROJECT')
 BACKEND_URL = os.getenv('BACKEND_URL')
 APP_NAME = os.getenv('APP_NAME')
 FROM_EMAIL = os.getenv("FROM_EMAIL")
+SEARCH_CACHE_TTL = 60
 STRIPE_PLANS = {
     'monthly': os.getenv('PRICE_MONTHLY'),
     'yearly': os.getenv('PRICE_YEARLY'),
     'lifetime': os.getenv("PRICE_LIFETIME")
 }
 
+# the API version stripe 7.10.0 pinned, which the app was built against, stripe
+# 10.x would otherwise default to 2024-06-20
+STRIPE_API_VERSION = os.getenv('STRIPE_API_VERSION', '2023-10-16')
+
+stripe.api_key = STRIPE_SECRET_KEY
+stripe.api_version = STRIPE_API_VERSION
 insiderTradingApi = InsiderTradingApi(SEC_API_KEY)
 queryApi = QueryApi(SEC_API_KEY)
 logsnag = LogSnag(token=LOG_SNAG_API, project=LOG_SNAG_PROJECT)
@@ -72,9 +86,9 @@ def status():
 @app.post('/stripe/checkout-session/')
 async def stripe_checkout_session(data: CheckoutSession):
     try:
-        stripe.api_key = STRIPE_SECRET_KEY
-        mode = "payment" if isLifetime(data.plan) else 'subscription'
-        session = stripe.checkout.Session.create(
+        is_lt = isLifetime(data.plan)
+        mode = "payment" if is_lt else 'subscription'
+        session = await stripe.checkout.Session.create_async(
             cancel_url=f"{FRONTEND_URL}/",
             allow_promotion_codes=True,
             success_url=f"{BACKEND_URL}" + "/stripe/subscription-success?session_id={CHECKOUT_SESSION_ID}" +
@@ -91,102 +105,115 @@ async def stripe_checkout_session(data: CheckoutSession):
                 "plan_verbose": plan_names[data.plan]
             }
         )
-        return JSONResponse(status_code=200, content={
+        return ORJSONResponse(status_code=200, content={
             "session_url": session.url,
             "session_id": session.id
         })
     except Exception as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
+        return ORJSONResponse(status_code=400, content={"error": str(e)})
+
+
+def track_new_subscription(session, user_id, is_lifetime):
+    """
+    Send the "New Subscription" LogSnag notification for a completed checkout.
+
+    Runs in a worker thread, failures are logged and never propagated.
+    """
+    try:
+        amount = calculate_amount(stripe, session)
+        customer_name = session.get('customer_details', {}).get("name", "")
+        customer_email = session.get(
+            'customer_details', {}).get("email", "")
+        lifetime_text = 'Lifetime' if is_lifetime else ""
+        description = f"Hooray! New Customer {customer_name} bought {lifetime_text} Subscription for ${amount} on {APP_NAME}."
+
+        logsnag.track(
+            channel="new-subscription",
+            event="New Subscription",
+            user_id=user_id,
+            description=description,
+            icon="💰",
+            notify=True,
+            tags={
+                    'app': APP_NAME,
+                    'date': str(datetime.now().date()),
+                    'customer_name': customer_name,
+                    'customer_email': customer_email
+            }
+        )
+
+    except Exception as e:
+        print(
+            f"Failed To Send Log Snag Notification Due To Following Exception: {str(e)}")
 
 
 @app.get("/stripe/subscription-success")
 async def subscription_success(session_id: str, user_id: str):
     try:
-        stripe.api_key = STRIPE_SECRET_KEY
-        session = stripe.checkout.Session.retrieve(session_id)
+        # expand the related objects so the LogSnag amount doesn't need
+        # a second round-trip to retrieve the subscription
+        session = await stripe.checkout.Session.retrieve_async(
+            session_id, expand=['subscription', 'customer'])
 
-        plan = session['metadata']['plan']
-        plan_full_name = session['metadata']['plan_verbose']
+        session_meta = session['metadata']
+        plan_full_name = session_meta['plan_verbose']
+        is_lt = isLifetime(session_meta['plan'])
 
-        subscription = session['subscription'] if not isLifetime(
-            plan) else None
+        subscription = get_object_id(
+            session['subscription']) if not is_lt else None
 
-        supabase.table(USERS_TABLE).update({
-            "customer_id": session['customer'],
+        update_user = supabase.table(USERS_TABLE).update({
+            "customer_id": get_object_id(session['customer']),
             "subscription_id": subscription,
             "is_active": True,
             "plan": plan_full_name,
-            "has_lifetime_access": isLifetime(plan)
-        }).eq('user_id', user_id).execute()
-
-        # send logsnag notification
-        try:
-            amount = calculate_amount(stripe, session)
-            customer_name = session.get('customer_details', {}).get("name", "")
-            customer_email = session.get(
-                'customer_details', {}).get("email", "")
-            lifetime_text = 'Lifetime' if isLifetime(plan) else ""
-            description = f"Hooray! New Customer {customer_name} bought {lifetime_text} Subscription for ${amount} on {APP_NAME}."
-
-            logsnag.track(
-                channel="new-subscription",
-                event="New Subscription",
-                user_id=user_id,
-                description=description,
-                icon="💰",
-                notify=True,
-                tags={
-                        'app': APP_NAME,
-                        'date': str(datetime.now().date()),
-                        'customer_name': customer_name,
-                        'customer_email': customer_email
-                }
-            )
+            "has_lifetime_access": is_lt
+        }).eq('user_id', user_id)
 
-        except Exception as e:
-            print(
-                f"Failed To Send Log Snag Notification Due To Following Exception: {str(e)}")
+        # update the user & send logsnag notification concurrently
+        await asyncio.gather(
+            run_in_threadpool(update_user.execute),
+            run_in_threadpool(track_new_subscription, session, user_id, is_lt)
+        )
 
         return RedirectResponse(url=FRONTEND_URL)
     except Exception as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
+        return ORJSONResponse(status_code=400, content={"error": str(e)})
 
 
 @app.get('/stripe/customer_portal')
 async def create_stripe_portal(customer_id: str):
     try:
-        stripe.api_key = STRIPE_SECRET_KEY
-        portal_session = stripe.billing_portal.Session.create(customer=customer_id,
-                                                              return_url=FRONTEND_URL,)
-        return JSONResponse(status_code=200, content={
+        portal_session = await stripe.billing_portal.Session.create_async(customer=customer_id,
+                                                                          return_url=FRONTEND_URL,)
+        return ORJSONResponse(status_code=200, content={
             "session_url": portal_session.url,
         })
     except Exception as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
+        return ORJSONResponse(status_code=400, content={"error": str(e)})
 
 
 @app.get('/stripe/verify-subscription')
 async def verify_subscription(user_id: str, subscription_id: str):
     try:
-        stripe.api_key = STRIPE_SECRET_KEY
-        subscriptions = stripe.Subscription.retrieve(subscription_id)
+        subscriptions = await stripe.Subscription.retrieve_async(subscription_id)
 
         if subscriptions['status'] == "active":
-            return JSONResponse(status_code=200, content={
+            return ORJSONResponse(status_code=200, content={
                 "status": True,
                 "message": "Subscription Successfully verified."
             })
 
-        supabase.table(USERS_TABLE).update({
+        await run_in_threadpool(supabase.table(USERS_TABLE).update({
             'is_active': False
-        }).eq('id', user_id).execute()
-        return JSONResponse(status_code=200, content={
+        }).eq('id', user_id).execute)
+        return ORJSONResponse(status_code=200, content={
             "status": False,
             "message": "User Does not have an active subscriptions."
         })
 
     except Exception as e:
-        return JSONResponse(status_code=400, content={"error": str(e)})
+        return ORJSONResponse(status_code=400, content={"error": str(e)})
 
 
 # ============================================
@@ -194,6 +221,39 @@ async def verify_subscription(user_id: str, subscription_id: str):
 #                 Search APIs
 # ============================================
 # ============================================
+@lru_cache(maxsize=256)
+def search_response(time_bucket, offset, filters):
+    """
+    Build the serialized `/search` payload for the given filters.
+
+    Results are memoized per `time_bucket` (the current SEARCH_CACHE_TTL window),
+    so identical searches within the window are served from memory and entries
+    from older windows simply stop being hit and get evicted.
+
+    Args:
+        time_bucket (int): `int(time.time() // SEARCH_CACHE_TTL)`.
+        offset (int): The offset for paginating the results.
+        filters (tuple): Sorted `(name, value)` pairs passed to `get_insider_trades`.
+
+    Returns:
+        bytes: The JSON encoded response body.
+    """
+    result = get_insider_trades(offset, **dict(filters))
+
+    return orjson.dumps({
+        'meta': {
+            'offset': offset,
+            'length': len(result['data']),
+            'total': {
+                'value': result['total']
+            },
+            'has_more': result['has_more'],
+            'next_cursor': result['next_cursor']
+        },
+        'data': result['data']
+    })
+
+
 @app.get("/search")
 async def search(
     sort: int = 1,
@@ -212,43 +272,41 @@ async def search(
     ownership_increase_min: float = None,
     ownership_increase_max: float = None,
     offset: int = 0,
+    cursor: str = None,
     disclosed_date: str = None,
-    transaction_type: str = "P"
+    transaction_type: str = "P",
+    count_mode: str = "planned"
 ):
     try:
-        result = get_insider_trades(offset,
-                                    ticker=ticker,
-                                    q=q,
-                                    sort=sort,
-                                    sector=sector,
-                                    market_cap=market_cap,
-                                    share_count_min=share_count_min,
-                                    share_count_max=share_count_max,
-                                    share_price_min=share_price_min,
-                                    share_price_max=share_price_max,
-                                    total_amount_min=total_amount_min,
-                                    total_amount_max=total_amount_max,
-                                    total_share_min=total_share_min,
-                                    total_share_max=total_share_max,
-                                    ownership_increase_min=ownership_increase_min,
-                                    ownership_increase_max=ownership_increase_max,
-                                    transaction_type=transaction_type,
-                                    disclosed_date=disclosed_date
-                                    )
-
-        return JSONResponse(status_code=200, content={**{
-            'meta': {
-                'offset': offset,
-                'length': len(result['data']),
-                'total': {
-                    'value': result['total']
-                }
-            },
-            'data': result['data']
-        }})
+        filters = tuple(sorted({
+            'ticker': ticker,
+            'q': q,
+            'sort': sort,
+            'sector': sector,
+            'market_cap': market_cap,
+            'share_count_min': share_count_min,
+            'share_count_max': share_count_max,
+            'share_price_min': share_price_min,
+            'share_price_max': share_price_max,
+            'total_amount_min': total_amount_min,
+            'total_amount_max': total_amount_max,
+            'total_share_min': total_share_min,
+            'total_share_max': total_share_max,
+            'ownership_increase_min': ownership_increase_min,
+            'ownership_increase_max': ownership_increase_max,
+            'transaction_type': transaction_type,
+            'disclosed_date': disclosed_date,
+            'cursor': cursor,
+            'count_mode': count_mode
+        }.items()))
+
+        content = await run_in_threadpool(search_response,
+                                          int(time.time() // SEARCH_CACHE_TTL),
+                                          offset, filters)
+        return Response(status_code=200, content=content, media_type="application/json")
 
     except Exception as e:
-        return JSONResponse(status_code=200, content={'error': str(e)})
+        return ORJSONResponse(status_code=200, content={'error': str(e)})
 
 
 # ============================================
@@ -263,33 +321,33 @@ async def cancellation(email_type: str, user_id: int, ticker: str = None):
         return RedirectResponse(url=FRONTEND_URL)
 
     except Exception as e:
-        return JSONResponse(status_code=200, content={'error': str(e)})
+        return ORJSONResponse(status_code=200, content={'error': str(e)})
 
 
 @app.post('/phone/request_verification/')
 async def request_verification(data: RequestOtp):
     try:
         status = send_verifiction_otp(data.phone)
-        return JSONResponse(status_code=200, content={**{
+        return ORJSONResponse(status_code=200, content={**{
             'status': status
         }})
 
     except Exception as e:
         print(f"FAILED TO SEND OPT WITH FOLLOWING EXCEPTION: {str(e)}")
-        return JSONResponse(status_code=200, content={'error': "Failed To Send OTP Try Again."})
+        return ORJSONResponse(status_code=200, content={'error': "Failed To Send OTP Try Again."})
 
 
 @app.post('/phone/verfiy/')
 async def verfiy(data: VerifyOtp):
     try:
         status = verify_otp(data.phone, data.code)
-        return JSONResponse(status_code=200, content={**{
+        return ORJSONResponse(status_code=200, content={**{
             'status': status
         }})
 
     except Exception as e:
         print(f"FAILED TO VERIFY OPT WITH FOLLOWING EXCEPTION: {str(e)}")
-        return JSONResponse(status_code=200, content={'error': "Failed To Verify OTP! Try Again."})
+        return ORJSONResponse(status_code=200, content={'error': "Failed To Verify OTP! Try Again."})
 
 
 # ============================================
@@ -345,9 +403,9 @@ async def test_email():
         # has_trades, a, b = get_recent_trades()
         # data = daily_digest()
         # data = weekly_sector_report()
-        return JSONResponse(status_code=200, content={**{
+        return ORJSONResponse(status_code=200, content={**{
             'data': True
         }})
 
     except Exception as e:
-        return JSONResponse(status_code=200, content={'error': str(e)})
+        return ORJSONResponse(status_code=200, content={'error': str(e)})
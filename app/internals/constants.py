@@ -1,3 +1,5 @@
+from types import MappingProxyType
+
 market_cap_categories = {
     'Micro': {'min': None, 'max': 300_000_000},
     'Small': {'min': 300_000_000, 'max': 2_000_000_000},
@@ -5,14 +7,14 @@ market_cap_categories = {
     'Large Cap': {'min': 10_000_000_000, 'max': None}
 }
 
-market_cap_options = {
+market_cap_options = MappingProxyType({
   1: "Micro",
   2: "Small",
   3: "Mid",
   4: "Large Cap",
-}
+})
 
-sort_options = {
+sort_options = MappingProxyType({
     1: "disclosed_date-desc",
     2: "disclosed_date-asc",
     3: "total_amount_spent-desc",
@@ -23,7 +25,7 @@ sort_options = {
     8: "total_shares-asc",
     9: "change_in_shares_percentage-desc",
     10: "change_in_shares_percentage-asc",
-}
+})
 
 plan_names = {
   'monthly': 'Pro Monthly Plan',
@@ -31,7 +33,7 @@ plan_names = {
   'lifetime': 'Pro Lifetime Plan'  
 }
 
-sector_options = {
+sector_options = MappingProxyType({
     1: 'Real Estate',
     2: 'Healthcare',
     3: 'Basic Materials',
@@ -43,7 +45,7 @@ sector_options = {
     9: 'Financial Services',
     10: 'Technology',
     11: 'Communication Services'
-}
+})
 
 sectors_with_ticker = {
   "Real Estate": [
@@ -1,8 +1,22 @@
-from datetime import datetime
 from .constants import sectors_with_ticker, market_cap_with_ticker, sector_options, \
     market_cap_options
 
 
+# Inverted lookup tables, built once at import so the getters below are O(1).
+# Iterating in reverse keeps the first matching key, like a linear scan would.
+_TICKER_TO_SECTOR = {ticker: sector for sector, tickers in reversed(
+    sectors_with_ticker.items()) for ticker in tickers}
+_TICKER_TO_MARKET_CAP = {ticker: market_cap for market_cap, tickers in reversed(
+    market_cap_with_ticker.items()) for ticker in tickers}
+_SECTOR_NAME_TO_KEY = {name: key for key,
+                       name in reversed(sector_options.items())}
+_MARKET_CAP_NAME_TO_KEY = {name: key for key,
+                           name in reversed(market_cap_options.items())}
+
+_MONTH_ABBR = ('', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
 def get_sector(ticker):
     """
     Get the sector for a given stock ticker.
@@ -16,10 +30,7 @@ def get_sector(ticker):
     Example:
         sector_category = get_sector('AAPL')
     """
-    for key, value in sectors_with_ticker.items():
-        if ticker in value:
-            return key
-    return "N/A"
+    return _TICKER_TO_SECTOR.get(ticker, "N/A")
 
 
 def get_sector_key(sector_name):
@@ -32,10 +43,7 @@ def get_sector_key(sector_name):
     Returns:
         int or None: The key of the sector if found, or None if not found.
     """
-    for key, name in sector_options.items():
-        if name == sector_name:
-            return key
-    return None
+    return _SECTOR_NAME_TO_KEY.get(sector_name)
 
 
 def get_market_cap(ticker):
@@ -52,10 +60,7 @@ def get_market_cap(ticker):
     Example:
         market_cap_category = get_market_cap('AAPL')
     """
-    for key, value in market_cap_with_ticker.items():
-        if ticker in value:
-            return key
-    return "N/A"
+    return _TICKER_TO_MARKET_CAP.get(ticker, "N/A")
 
 
 def get_market_cap_key(market_cap):
@@ -68,10 +73,7 @@ def get_market_cap_key(market_cap):
     Returns:
         int or None: The key of the sector if found, or None if not found.
     """
-    for key, name in market_cap_options.items():
-        if name == market_cap:
-            return key
-    return None
+    return _MARKET_CAP_NAME_TO_KEY.get(market_cap)
 
 
 def email_formatter(data):
@@ -108,22 +110,30 @@ def email_formatter(data):
             # ...
         ])
     """
+    # periodOfReport is always an ISO date (YYYY-MM-DD), so '%b %d' is built by
+    # slicing the string instead of parsing it into a datetime for every row.
+    # Share counts and amounts are never negative, so `int(x + 0.5)` rounds half-up
+    # without going through round() and the '{:,}' format spec parser.
+    month_abbr = _MONTH_ABBR
+    _round = round
+
     return [{
         "filling": item["filling"],
         "accessionNo": item["accessionNo"],
         "ticker": item["ticker"],
         "sector": item["sector"],
         "market_cap": item["market_cap"],
-        "periodOfReport": datetime.fromisoformat(item["periodOfReport"]).strftime('%b %d'),
+        "periodOfReport": f"{month_abbr[int(item['periodOfReport'][5:7])]} {item['periodOfReport'][8:10]}",
         "transaction_type": item["transaction_type"].lower(),
         "ceo_name": item["ceo_name"].title(),
         "company_name": item["company_name"].title(),
-        "total_shares": '{:,}'.format(int(round(item['total_shares'], 0))),
-        "share_price": round(item['share_price'], 2),
+        "total_shares": f"{int(item['total_shares'] + 0.5):,d}",
+        # round() keeps whole prices (returned as int by PostgREST) as int
+        "share_price": _round(item['share_price'], 2),
         "disclosed_date": item["disclosed_date"],
-        "total_amount_spent": '{:,}'.format(int(round(item["total_amount_spent"], 0))),
-        "total_shares_after_transaction": '{:,}'.format(int(round(item["total_shares_after_transaction"], 0))),
-        "change_in_shares_percentage": round(item["change_in_shares_percentage"], 3),
+        "total_amount_spent": f"{int(item['total_amount_spent'] + 0.5):,d}",
+        "total_shares_after_transaction": f"{int(item['total_shares_after_transaction'] + 0.5):,d}",
+        "change_in_shares_percentage": _round(item["change_in_shares_percentage"], 3),
         "link": item["link"],
     } for item in data]
     
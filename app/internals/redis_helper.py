@@ -0,0 +1,56 @@
+import redis
+
+
+# db 0 and 1 are the Celery broker and result backend (see worker.py)
+REDIS_CACHE_URL = "redis://localhost:6379/2"
+PRICE_CACHE_TTL = 86400
+
+# connects lazily, on the first command
+client = redis.Redis.from_url(REDIS_CACHE_URL)
+
+
+def price_key(ticker, date):
+    return f"price:{ticker}:{date}"
+
+
+def get_cached_prices(keys):
+    """
+    Look up cached adjusted closing prices with a single MGET.
+
+    Args:
+        keys (iterable): (ticker, "%Y-%m-%d" date) pairs.
+
+    Returns:
+        dict: (ticker, date) -> price for the pairs found in the cache. Empty if
+        Redis is unreachable, so callers just fall back to downloading.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+
+    try:
+        values = client.mget([price_key(ticker, date) for ticker, date in keys])
+    except redis.RedisError as e:
+        print(f"Failed To Read Cached Prices with exception: {str(e)}", flush=True)
+        return {}
+
+    return {key: float(value) for key, value in zip(keys, values) if value is not None}
+
+
+def cache_prices(prices):
+    """
+    Cache adjusted closing prices for PRICE_CACHE_TTL seconds, in one pipeline.
+
+    Args:
+        prices (dict): (ticker, "%Y-%m-%d" date) -> price.
+    """
+    if not prices:
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for (ticker, date), price in prices.items():
+            pipeline.setex(price_key(ticker, date), PRICE_CACHE_TTL, price)
+        pipeline.execute()
+    except redis.RedisError as e:
+        print(f"Failed To Cache Prices with exception: {str(e)}", flush=True)
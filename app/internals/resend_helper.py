@@ -1,11 +1,15 @@
 import os
-import resend
+import asyncio
+import aiohttp
 from datetime import datetime
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, \
+    wait_exponential_jitter
+from markupsafe import escape
 from jinja2 import Environment, select_autoescape, FileSystemLoader
 from .supabase_helper import get_recent_trades, get_user_emails, \
-    get_weekly_sector_data, get_ticker_track_record, \
-    get_users_for_notification
+    get_weekly_sector_data, get_ticker_track_record_batch_async, \
+    get_users_for_notifications_batch_async
 from .twilio_helper import send_message_notification
 from .jinja_helper import env
 from .formatters import email_formatter
@@ -23,10 +27,121 @@ DASHBOARD = f"{FRONTEND_URL}/dashboard"
 SEARCH_LINK = f"{FRONTEND_URL}/search?offset=0"
 PURCHASE_LINK = F"{SEARCH_LINK}&disclosed_date=2024-01-02&transaction_type=P"
 SALE_LINK = F"{SEARCH_LINK}&disclosed_date=2024-01-02&transaction_type=S"
-resend.api_key = RESEND_API_KEY
+RESEND_BATCH_URL = "https://api.resend.com/emails/batch"
+# most emails Resend accepts in one batch request
+RESEND_BATCH_SIZE = 100
+# Resend's default team rate limit is 2 requests per second
+RESEND_REQUESTS_PER_SECOND = float(os.getenv("RESEND_REQUESTS_PER_SECOND", 2))
+RESEND_RETRIES = 5
+CANCELLATION_TOKEN = "__CANCELLATION_URL__"
 
+DAILY_TMPL = env.get_template('daily_digest.html')
+WEEKLY_TMPL = env.get_template('weekly_sector_report.html')
+SIGNAL_TMPL = env.get_template('signal_email.html')
 
-def daily_digest():
+
+class ResendRetryableError(Exception):
+    """
+    A rate limited (429) or failed (5xx) Resend request, `retry_after` is the
+    delay in seconds Resend asked for, None without a Retry-After header.
+    """
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"Resend answered with status {status}")
+        self.retry_after = retry_after
+
+
+class AsyncRateLimiter:
+    """
+    Spaces `acquire` calls at least 1 / rate seconds apart on the running loop.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+def parse_retry_after(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+backoff = wait_exponential_jitter(initial=1, max=30)
+
+
+def wait_for_resend(retry_state):
+    # wait as long as Resend asked for, back off with jitter otherwise
+    retry_after = getattr(retry_state.outcome.exception(), 'retry_after', None)
+    return retry_after if retry_after is not None else backoff(retry_state)
+
+
+@retry(retry=retry_if_exception_type((ResendRetryableError, aiohttp.ClientConnectionError)),
+       wait=wait_for_resend,
+       stop=stop_after_attempt(RESEND_RETRIES),
+       reraise=True)
+async def send_batch(session, rate_limiter, batch):
+    await rate_limiter.acquire()
+    async with session.post(RESEND_BATCH_URL, json=batch) as resp:
+        if resp.status == 429 or resp.status >= 500:
+            raise ResendRetryableError(
+                resp.status, parse_retry_after(resp.headers.get('Retry-After')))
+        resp.raise_for_status()
+        return await resp.json()
+
+
+async def send_emails(emails, recipients):
+    """
+    Send emails through the Resend batch API, RESEND_BATCH_SIZE emails per
+    request and at most RESEND_REQUESTS_PER_SECOND requests per second.
+
+    Rate limited and failed requests are retried, honoring Retry-After, up to
+    RESEND_RETRIES attempts. A batch that still fails never aborts the others,
+    it is logged and its recipients are reported back so only they need to be
+    retried.
+
+    Args:
+        emails (list): A list of Resend email params ('from', 'to', 'subject', 'html').
+        recipients (list): The recipient identifier of each email (e.g. a user id),
+                           reported back for the emails that failed.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - int: Number of emails sent successfully.
+            - list: The recipients of the emails that failed to send.
+    """
+    rate_limiter = AsyncRateLimiter(RESEND_REQUESTS_PER_SECOND)
+    headers = {"Authorization": f"Bearer {RESEND_API_KEY}"}
+    starts = range(0, len(emails), RESEND_BATCH_SIZE)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        results = await asyncio.gather(
+            *[send_batch(session, rate_limiter, emails[start:start + RESEND_BATCH_SIZE])
+              for start in starts],
+            return_exceptions=True)
+
+    failures = []
+    for start, result in zip(starts, results):
+        if isinstance(result, Exception):
+            failed = recipients[start:start + RESEND_BATCH_SIZE]
+            failures.extend(failed)
+            print(
+                f"Failed To Send {len(failed)} Emails with Exception: {str(result)}", flush=True)
+    return len(emails) - len(failures), failures
+
+
+def render_for_user(html, cancellation_url):
+    return html.replace(CANCELLATION_TOKEN, str(escape(cancellation_url)))
+
+
+async def daily_digest():
     """
     Generate a daily digest by pulling data from Supabase and sending an email.
 
@@ -36,121 +151,132 @@ def daily_digest():
     Sends the generated HTML email to specified recipients.
 
     Returns:
-        bool: True if the daily digest is generated and the email is sent successfully,
-              or if there are no trades found for the day.
+        tuple: (success_count, failures) where failures is the list of user ids the
+               digest could not be sent to. (0, []) if there are no trades found for the day.
 
     Example:
-        result = daily_digest()
+        sent, failed_user_ids = asyncio.run(daily_digest())
     """
-    try:
-        has_trades, trades_p, trades_s = get_recent_trades()
-        users = get_user_emails('D')
-        template = env.get_template('daily_digest.html')
+    has_trades, trades_p, trades_s = await get_recent_trades()
+    users = get_user_emails('D')
 
-        if not has_trades or not len(users):
-            print(
-                "No Trades Found Today or 0 Users Found with active settings!", flush=True)
-            return True
-
-        trades = {
-            'purchase': {
-                'data': email_formatter(trades_p.data),
-                'count': trades_p.count
-            },
-            'sale': {
-                'data': email_formatter(trades_s.data),
-                'count': trades_s.count
-            }
+    if not has_trades or not len(users):
+        print(
+            "No Trades Found Today or 0 Users Found with active settings!", flush=True)
+        return 0, []
+
+    trades = {
+        'purchase': {
+            'data': email_formatter(trades_p.data),
+            'count': trades_p.count
+        },
+        'sale': {
+            'data': email_formatter(trades_s.data),
+            'count': trades_s.count
         }
-        # return trades
-        for user in users:
-            html = template.render(
-                purchase=trades['purchase'], sale=trades['sale'],
-                p_link=PURCHASE_LINK, s_link=SALE_LINK, dashboard=DASHBOARD,
-                cancellation_url=f"{BACKEND_URL}/emails/cancel?email_type=d&user_id={user['id']}")
-            params = {
-                "from": FROM_EMAIL,
-                "to": user['email'],
-                "subject": "Daily Digest",
-                "html": html,
-            }
-            email = resend.Emails.send(params)
-        return True
-    except Exception as error:
+    }
+    html = DAILY_TMPL.render(
+        purchase=trades['purchase'], sale=trades['sale'],
+        p_link=PURCHASE_LINK, s_link=SALE_LINK, dashboard=DASHBOARD,
+        cancellation_url=CANCELLATION_TOKEN)
+    emails = [{
+        "from": FROM_EMAIL,
+        "to": user['email'],
+        "subject": "Daily Digest",
+        "html": render_for_user(html, f"{BACKEND_URL}/emails/cancel?email_type=d&user_id={user['id']}"),
+    } for user in users]
+
+    sent, failures = await send_emails(emails, [user['id'] for user in users])
+    if failures:
         print(
-            f"Faild To Send Daily Digest Email on Date: {datetime.now().date()} with Exception: {str(error)}", flush=True)
-        return False
+            f"Faild To Send Daily Digest Email on Date: {datetime.now().date()} to {len(failures)} users", flush=True)
+    return sent, failures
 
 
-def weekly_sector_report():
-    try:
-        data = get_weekly_sector_data()
-        users = get_user_emails('W')
-        template = env.get_template('weekly_sector_report.html')
+async def weekly_sector_report():
+    """
+    Send the weekly sector report to every user subscribed to it.
 
-        if not bool(data and any(data.values())) or not len(users):
-            print(
-                "No Trades Found Today or 0 Users Found with active settings!", flush=True)
-            return True
-
-        week_number = datetime.now().isocalendar()[1]
-        for user in users:
-            html = template.render(trades=data, week_number=week_number,
-                                   search_link=SEARCH_LINK, dashboard=DASHBOARD,
-                                   cancellation_url=f"{BACKEND_URL}/emails/cancel?email_type=w&user_id={user['id']}")
-            params = {
-                "from": FROM_EMAIL,
-                "to": user['email'],
-                "subject": f"Weekly Sector Report - Week {week_number}",
-                "html": html,
-            }
-
-            email = resend.Emails.send(params)
-        return True
-    except Exception as error:
+    Returns:
+        tuple: (success_count, failures) where failures is the list of user ids the
+               report could not be sent to.
+    """
+    data = await get_weekly_sector_data()
+    users = get_user_emails('W')
+
+    if not bool(data and any(data.values())) or not len(users):
         print(
-            f"Faild To Send Weekly Sector Report Email on Date: {datetime.now().date()} with Exception: {str(error)}", flush=True)
-        return False
+            "No Trades Found Today or 0 Users Found with active settings!", flush=True)
+        return 0, []
 
+    week_number = datetime.now().isocalendar()[1]
+    html = WEEKLY_TMPL.render(trades=data, week_number=week_number,
+                              search_link=SEARCH_LINK, dashboard=DASHBOARD,
+                              cancellation_url=CANCELLATION_TOKEN)
+    emails = [{
+        "from": FROM_EMAIL,
+        "to": user['email'],
+        "subject": f"Weekly Sector Report - Week {week_number}",
+        "html": render_for_user(html, f"{BACKEND_URL}/emails/cancel?email_type=w&user_id={user['id']}"),
+    } for user in users]
 
-def signal_notification(items):
-    try:
-        for data in items:
-            users = get_users_for_notification(data['ticker'], data)
-            track_record = get_ticker_track_record(data['ticker'])
-            template = env.get_template('signal_email.html')
-
-            if len(users['emails']):
-                formatted_data = email_formatter([data])[0]
-                _type = "acquired" if data['transaction_type'].lower(
-                ) == 'p' else "disposed"
-
-                for email in users['emails']:
-                    html = template.render(
-                        data=formatted_data,
-                        track_record=email_formatter(track_record),
-                        cancellation_url=f"{FRONTEND_URL}/dashboard")
-
-                    params = {
-                        "from": FROM_EMAIL,
-                        "to": email,
-                        "subject": f"{data['ticker'].upper()}'s CEO just {_type} {formatted_data['total_shares']} shares!",
-                        "html": html,
-                    }
-                    email = resend.Emails.send(params)
-            else:
-                print('No Users Which Ticker Inside their watchlist', flush=True)
-
-            # Disableing Phone Notification
-            # This will be fully removed in the weekend.
-            # if len(users['phones']):
-            #     for phone in users['phones']:
-            #         send_message_notification(phone, formatted_data)
-            # else:
-            #     print('No Users with phone numbers')
-
-        return True
-    except Exception as error:
+    sent, failures = await send_emails(emails, [user['id'] for user in users])
+    if failures:
+        print(
+            f"Faild To Send Weekly Sector Report Email on Date: {datetime.now().date()} to {len(failures)} users", flush=True)
+    return sent, failures
+
+
+async def signal_notification(items):
+    """
+    Send the signal email of each trade to its watchlist, activity and custom
+    notification users.
+
+    Returns:
+        tuple: (success_count, failures) where failures is the list of
+               (accessionNo, email) pairs of the signals that could not be sent.
+    """
+    emails = []
+    recipients = []
+    users_by_item, track_records = await asyncio.gather(
+        get_users_for_notifications_batch_async(items),
+        get_ticker_track_record_batch_async({data['ticker'] for data in items}))
+
+    for data, users in zip(items, users_by_item):
+        track_record = track_records[data['ticker']]
+
+        if len(users['emails']):
+            formatted_data = email_formatter([data])[0]
+            _type = "acquired" if data['transaction_type'].lower(
+            ) == 'p' else "disposed"
+
+            html = SIGNAL_TMPL.render(
+                data=formatted_data,
+                track_record=email_formatter(track_record),
+                cancellation_url=f"{FRONTEND_URL}/dashboard")
+            subject = f"{data['ticker'].upper()}'s CEO just {_type} {formatted_data['total_shares']} shares!"
+
+            for email in users['emails']:
+                emails.append({
+                    "from": FROM_EMAIL,
+                    "to": email,
+                    "subject": subject,
+                    "html": html,
+                })
+                recipients.append((data['accessionNo'], email))
+        else:
+            print('No Users Which Ticker Inside their watchlist', flush=True)
+
+        # Disableing Phone Notification
+        # This will be fully removed in the weekend.
+        # if len(users['phones']):
+        #     for phone in users['phones']:
+        #         send_message_notification(phone, formatted_data)
+        # else:
+        #     print('No Users with phone numbers')
+
+    sent, failures = await send_emails(emails, recipients)
+    if failures:
         print(
-            f"Faild To Send Signal Email on Date: {datetime.now().date()} with Exception: {str(error)}", flush=True)
-        return False
+            f"Faild To Send Signal Email on Date: {datetime.now().date()} to {len(failures)} users", flush=True)
+    return sent, failures
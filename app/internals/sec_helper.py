@@ -0,0 +1,136 @@
+import time
+import requests
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception, stop_after_attempt, \
+    wait_exponential_jitter
+from sec_api import InsiderTradingApi as BaseInsiderTradingApi, \
+    QueryApi as BaseQueryApi
+
+
+QUERY_API_ENDPOINT = "https://api.sec-api.io"
+INSIDER_TRADING_API_ENDPOINT = "https://api.sec-api.io/insider-trading"
+SEC_API_TIMEOUT = 30
+SEC_API_RETRIES = 6
+SEC_API_POOL_SIZE = 32
+# shared by every client and thread, below the API's 10 requests per second
+SEC_API_REQUESTS_PER_SECOND = 9
+
+
+# ============================================
+# ============================================
+#                 Session
+# ============================================
+# ============================================
+def create_session():
+    """
+    Create the `requests` session shared by every SEC API client.
+
+    `sec_api` posts with the module level `requests.post`, which opens a new
+    TCP/TLS connection per call. Going through one session keeps the connections
+    alive and reuses them across calls and threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=SEC_API_POOL_SIZE,
+                          pool_maxsize=SEC_API_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+
+session = create_session()
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket, `acquire` blocks until a request may be sent.
+
+    The bucket holds a single token, so requests are spaced at least 1 / rate
+    seconds apart and an idle period never allows a burst above the rate.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(1, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(SEC_API_REQUESTS_PER_SECOND)
+
+
+def is_retryable(exception):
+    """
+    Rate limits, server errors and connection problems are worth retrying, other
+    errors (e.g. a malformed query) would just fail again.
+    """
+    if isinstance(exception, requests.HTTPError):
+        status_code = exception.response.status_code if exception.response is not None else 0
+        return status_code == 429 or status_code >= 500
+    return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+
+
+@retry(retry=retry_if_exception(is_retryable),
+       wait=wait_exponential_jitter(initial=0.5, max=30),
+       stop=stop_after_attempt(SEC_API_RETRIES),
+       reraise=True)
+def post(endpoint, api_key, query, proxies=None):
+    """
+    POST a query to a SEC API endpoint, at most SEC_API_REQUESTS_PER_SECOND per
+    second across all threads. Rate limited, failed and dropped requests are
+    retried with exponential backoff and jitter, up to SEC_API_RETRIES attempts.
+
+    Args:
+        endpoint (str): The API endpoint.
+        api_key (str): The SEC API key.
+        query (dict): The query body.
+        proxies (dict, optional): `requests` proxies, as given to the client.
+
+    Returns:
+        dict: The decoded JSON response.
+
+    Raises:
+        requests.HTTPError: If the API keeps answering with an error status.
+    """
+    rate_limiter.acquire()
+    response = session.post(endpoint, params={'token': api_key}, json=query,
+                            proxies=proxies, timeout=SEC_API_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+# ============================================
+# ============================================
+#                 Clients
+# ============================================
+# ============================================
+class InsiderTradingApi(BaseInsiderTradingApi):
+    """
+    `sec_api.InsiderTradingApi` with `get_data` going through the shared session.
+    """
+
+    def get_data(self, query):
+        return post(INSIDER_TRADING_API_ENDPOINT, self.api_key, query,
+                    self.proxies)
+
+
+class QueryApi(BaseQueryApi):
+    """
+    `sec_api.QueryApi` with `get_filings` going through the shared session.
+    """
+
+    def get_filings(self, query):
+        return post(QUERY_API_ENDPOINT, self.api_key, query, self.proxies)
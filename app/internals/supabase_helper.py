@@ -1,7 +1,12 @@
 import os
 import json
+import asyncio
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime, timedelta
-from supabase import create_client
+from supabase import create_client, Client
+from supabase._async.client import create_client as create_async_client
+from supabase.lib.client_options import ClientOptions
 from dotenv import load_dotenv
 from .formatters import custom_notification_formatter, email_formatter, get_sector_key
 from .constants import sort_options, market_cap_options, \
@@ -12,7 +17,50 @@ from .constants import sort_options, market_cap_options, \
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_PROJECT_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+SUPABASE_TIMEOUT = 10
+SECTOR_TRADE_LIMITS = {'p': 2, 's': 1}
+INSERT_CHUNK_SIZE = 1000
+PAGE_SIZE = 20
+KEYSET_SORT = 'disclosed_date-desc'
+COUNT_MODES = ('exact', 'planned', 'estimated')
+# Columns read by `email_formatter`
+EMAIL_FIELDS = "accessionNo,ticker,sector,market_cap,periodOfReport,transaction_type," \
+    "ceo_name,company_name,total_shares,share_price,disclosed_date,total_amount_spent," \
+    "total_shares_after_transaction,change_in_shares_percentage,filling,link"
+# columns returned by /search, every column written by `insert_data_into_table`
+# (the frontend reads them all), `id` is part of the keyset cursor
+SEARCH_FIELDS = "id,accessionNo,filling,cik,q,ticker,sector,market_cap,periodOfReport,transaction_type," \
+    "ceo_name,company_name,total_shares,share_price,disclosed_date,total_amount_spent," \
+    "total_shares_after_transaction,change_in_shares_percentage,link"
+# only the purchase table has the return columns
+SEARCH_RETURN_FIELDS = ",one_week_return,one_month_return,six_months_return"
+_async_supabase = None
+_async_supabase_loop = None
+# guards the client's creation, bound to its loop like the client
+_async_supabase_lock = None
+
+
+def get_client_options():
+    return ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT,
+                         storage_client_timeout=SUPABASE_TIMEOUT)
+
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    """
+    Get the process wide Supabase client.
+
+    The client is created once and memoized so every query reuses the same
+    PostgREST session (and its kept-alive connections) instead of paying a
+    new TCP + TLS handshake.
+
+    Returns:
+        Client: The sync Supabase client.
+    """
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=get_client_options())
+
+
+supabase = get_supabase()
 
 
 # ============================================
@@ -20,6 +68,36 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 #               Utilities
 # ============================================
 # ============================================
+async def get_async_supabase():
+    """
+    Get the async Supabase client for the running event loop.
+
+    The client's connection pool is bound to the loop it was created on, so a new
+    client is created whenever it is requested from a different loop
+    (e.g. one `asyncio.run` per Celery task). Concurrent first calls (e.g. from
+    `asyncio.gather`) wait on a per loop lock and share the one client.
+
+    Returns:
+        AsyncClient: The async Supabase client.
+    """
+    global _async_supabase, _async_supabase_loop, _async_supabase_lock
+
+    loop = asyncio.get_running_loop()
+    if _async_supabase is not None and _async_supabase_loop is loop:
+        return _async_supabase
+
+    # no await between the check and the assignment, so one lock per loop
+    if _async_supabase_lock is None or _async_supabase_lock[0] is not loop:
+        _async_supabase_lock = (loop, asyncio.Lock())
+
+    async with _async_supabase_lock[1]:
+        if _async_supabase is None or _async_supabase_loop is not loop:
+            _async_supabase = await create_async_client(
+                SUPABASE_URL, SUPABASE_KEY, options=get_client_options())
+            _async_supabase_loop = loop
+    return _async_supabase
+
+
 def get_database_table(trasaction_type):
     """
     Get the appropriate database table based on the transaction type.
@@ -38,7 +116,7 @@ def get_database_table(trasaction_type):
     return SALES_TABLE
 
 
-def get_recent_trades():
+async def get_recent_trades():
     """
     Retrieve the most recent trades from the purchase and sales tables.
 
@@ -48,21 +126,24 @@ def get_recent_trades():
 
     Returns:
         tuple: A tuple containing three elements:
-            - bool: True if the operation is successful, indicating that the trades were retrieved.
+            - bool: True if either table has trades for today.
             - dict: A dictionary containing the response from the purchase table query.
             - dict: A dictionary containing the response from the sales table query.
     """
+    client = await get_async_supabase()
     current_date = datetime.now().strftime("%Y-%m-%d")
-    resp_p = supabase.table(PURCHASE_TABLE).select(
-        "*", count='exact').gte('disclosed_date', current_date).limit(5).execute()
-    resp_s = supabase.table(SALES_TABLE).select(
-        "*", count='exact').gte('disclosed_date', current_date).limit(5).execute()
-
-    has_trades = resp_p.count or resp_s.count
+    resp_p, resp_s = await asyncio.gather(
+        client.table(PURCHASE_TABLE).select(
+            EMAIL_FIELDS, count='exact').gte('disclosed_date', current_date).limit(5).execute(),
+        client.table(SALES_TABLE).select(
+            EMAIL_FIELDS, count='exact').gte('disclosed_date', current_date).limit(5).execute()
+    )
+
+    has_trades = bool(resp_p.count or resp_s.count)
     return has_trades, resp_p, resp_s
 
 
-def get_weekly_sector_data():
+async def get_weekly_sector_data():
     """
     Retrieve weekly sector data from both purchase and sale transactions.
 
@@ -70,44 +151,49 @@ def get_weekly_sector_data():
         dict: A dictionary where keys are sectors and values are dictionaries
               containing 'p' and 's' lists representing purchase and sale transactions.
     """
+    client = await get_async_supabase()
+
     # Define the start date for the week
     one_week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
 
-    # Query for purchase transactions
-    query_p = supabase.table(PURCHASE_TABLE).select("*").filter(
-        'disclosed_date', 'gte', one_week_ago).neq(
-        'sector', 'null').neq('sector', 'N/A').order(
-        'total_amount_spent', desc=True)
-
-    # Query for sale transactions
-    query_s = supabase.table(SALES_TABLE).select("*").filter(
-        'disclosed_date', 'gte', one_week_ago).neq(
-        'sector', 'null').neq('sector', 'N/A').order(
-        'total_amount_spent', desc=True)
-
-    # Execute both queries
-    result_p = query_p.execute().data
-    result_s = query_s.execute().data
+    # The `weekly_sector_top` RPC (see readme) ranks each sector's trades by
+    # total_amount_spent in Postgres and only returns the top rows per sector
+    resp = await client.rpc('weekly_sector_top', {
+        'since': one_week_ago,
+        'limit_p': SECTOR_TRADE_LIMITS['p'],
+        'limit_s': SECTOR_TRADE_LIMITS['s']
+    }).execute()
+    result_p = resp.data['p']
+    result_s = resp.data['s']
+
+    # Bucket the rows (already sorted by amount) keeping at most
+    # SECTOR_TRADE_LIMITS trades per sector, and stop scanning a list as soon
+    # as every sector's bucket is full.
+    trades_by_sector = {}
 
-    # Format the results
-    formatted_result_p = email_formatter(result_p)
-    formatted_result_s = email_formatter(result_s)
+    for rows, transaction_type in ((result_p, 'p'), (result_s, 's')):
+        limit = SECTOR_TRADE_LIMITS[transaction_type]
+        full_sectors = set()
 
-    # Combine 'p' and 's' results while ensuring the desired distribution
-    trades_by_sector = {}
+        for trade in rows:
+            sector = trade['sector']
 
-    for trade in formatted_result_p + formatted_result_s:
-        sector = trade['sector']
-        transaction_type = trade['transaction_type'].lower()
+            if sector not in trades_by_sector:
+                trades_by_sector[sector] = {
+                    'p': [], 's': [], 'sector_id': get_sector_key(sector)}
 
-        if sector not in trades_by_sector:
-            trades_by_sector[sector] = {
-                'p': [], 's': [], 'sector_id': get_sector_key(sector)}
+            bucket = trades_by_sector[sector][transaction_type]
+            if len(bucket) < limit:
+                bucket.append(trade)
+                if len(bucket) == limit:
+                    full_sectors.add(sector)
+                    if len(full_sectors) == len(sector_options):
+                        break
 
-        if transaction_type == 'p' and len(trades_by_sector[sector]['p']) < 2:
-            trades_by_sector[sector]['p'].append(trade)
-        elif transaction_type == 's' and len(trades_by_sector[sector]['s']) < 1:
-            trades_by_sector[sector]['s'].append(trade)
+    # Format only the trades that made it into a bucket
+    for trades in trades_by_sector.values():
+        trades['p'] = email_formatter(trades['p'])
+        trades['s'] = email_formatter(trades['s'])
 
     return trades_by_sector
 
@@ -170,11 +256,21 @@ def get_insider_trades(offset, **kwargs):
             - ownership_increase_max (float): Maximum ownership increase percentage (for purchases).
             - sort (str): Sorting option (e.g., 'disclosed_date-asc').
             - disclosed_date (str) 2024-01-04
+            - cursor (str): `next_cursor` of the previous page, "<disclosed_date>,<id>".
+                            Only used with the 'disclosed_date-desc' sort, where it
+                            replaces `offset` (keyset pagination).
+            - count_mode (str): How the total is counted, one of COUNT_MODES. Defaults to
+                                'planned' (the planner's estimate), 'exact' runs a full
+                                COUNT(*) of the filtered rows and anything else skips it.
 
     Returns:
         dict: A dictionary containing the fetched data and the total count.
             - 'data': List of insider trade data.
-            - 'total': Total count of insider trades matching the filters.
+            - 'total': Total count of insider trades matching the filters, None
+                       when the count is skipped.
+            - 'has_more': Whether there is a next page.
+            - 'next_cursor': Cursor of the next page for the 'disclosed_date-desc'
+                             sort, None otherwise or on the last page.
 
     Example:
         get_insider_trades(
@@ -191,8 +287,11 @@ def get_insider_trades(offset, **kwargs):
     # Initialize a query with the table name
     transaction_type = kwargs.get('transaction_type')
     TABLE = get_database_table(transaction_type)
+    count_mode = kwargs.get('count_mode', 'planned')
+    fields = SEARCH_FIELDS + \
+        SEARCH_RETURN_FIELDS if TABLE == PURCHASE_TABLE else SEARCH_FIELDS
     query = supabase.table(TABLE).select(
-        "*", count='exact')
+        fields, count=count_mode if count_mode in COUNT_MODES else None)
 
     # Extract filters from kwargs
     search_query = kwargs.get('q')
@@ -217,13 +316,13 @@ def get_insider_trades(offset, **kwargs):
         query = query.in_('ticker', tickers_list)
 
     if sector is not None:
-        if sector in sector_options:
-            sector = sector_options[sector]
+        sector = sector_options.get(sector)
+        if sector is not None:
             query = query.eq('sector', sector)
 
     if market_cap is not None:
-        if market_cap in market_cap_options:
-            market_cap = market_cap_options[market_cap]
+        market_cap = market_cap_options.get(market_cap)
+        if market_cap is not None:
             query = query.eq('market_cap', market_cap)
 
     if TABLE == PURCHASE_TABLE:
@@ -257,18 +356,63 @@ def get_insider_trades(offset, **kwargs):
 
     # Extract sort column and order from the sort_option
     sort = kwargs.get('sort', None)
-    if sort is not None:
-        if sort in sort_options:
-            sort_option = sort_options[sort]
-            sort_column, sort_order = sort_option.split('-')
-
-            # Apply sorting to the query
-            query = query.order(sort_column, desc=(sort_order == 'desc'))
+    sort_option = sort_options.get(sort) if sort is not None else None
+
+    # The default (latest first) sort is paginated by keyset on
+    # (disclosed_date, id) so deep pages don't make Postgres skip `offset` rows
+    keyset = sort_option == KEYSET_SORT
+    cursor = kwargs.get('cursor') if keyset else None
+
+    if keyset:
+        # postgrest 0.13's `order()` adds another `order` parameter instead of
+        # extending it and PostgREST only applies one, so set both keys at once
+        query.params = query.params.set('order', 'disclosed_date.desc,id.desc')
+    elif sort_option is not None:
+        sort_column, sort_order = sort_option.split('-')
+
+        # Apply sorting to the query
+        query = query.order(sort_column, desc=(sort_order == 'desc'))
+
+    if cursor is not None:
+        # postgrest 0.13 has no `or_()` filter
+        cursor_date, cursor_id = parse_cursor(cursor)
+        query.params = query.params.add(
+            'or', f'(disclosed_date.lt."{cursor_date}",and(disclosed_date.eq."{cursor_date}",id.lt.{cursor_id}))')
+    else:
+        query = query.offset(offset)
 
-    query = query.offset(offset)
-    query = query.limit(20)
+    query = query.limit(PAGE_SIZE)
     response = query.execute()
-    return {'data': response.data, 'total': response.count}
+
+    has_more = len(response.data) == PAGE_SIZE
+
+    next_cursor = None
+    if keyset and has_more:
+        last = response.data[-1]
+        next_cursor = f"{last['disclosed_date']},{last['id']}"
+
+    return {'data': response.data, 'total': response.count, 'has_more': has_more, 'next_cursor': next_cursor}
+
+
+def parse_cursor(cursor):
+    """
+    Parse a `next_cursor` of `get_insider_trades`.
+
+    Args:
+        cursor (str): "<disclosed_date>,<id>".
+
+    Returns:
+        tuple: The ISO formatted disclosed date and the integer id, safe to put
+        in a PostgREST filter.
+
+    Raises:
+        ValueError: If the cursor isn't an ISO timestamp followed by an integer id.
+    """
+    try:
+        cursor_date, cursor_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(cursor_date).isoformat(), int(cursor_id)
+    except ValueError:
+        raise ValueError("Invalid cursor")
 
 
 def insert_data_into_table(items, **kwargs):
@@ -314,6 +458,8 @@ def insert_data_into_table(items, **kwargs):
             # ... (other required keys)
         })
     """
+    rows_by_table = {PURCHASE_TABLE: [], SALES_TABLE: []}
+
     for data in items:
         transaction_type = data.get('transaction_type')
         TABLE = get_database_table(transaction_type)
@@ -339,20 +485,42 @@ def insert_data_into_table(items, **kwargs):
             "link": data['link'],
         }
 
-        if transaction_type.lower() == 'p':
+        # Only the purchase table has the return columns
+        if TABLE == PURCHASE_TABLE:
             row['one_week_return'] = data['one_week_return']
             row['one_month_return'] = data['one_month_return']
             row['six_months_return'] = data['six_months_return']
 
-        if transaction_type.lower() == 's':
-            if row.get('one_week_return', ''):
-                del row['one_week_return']
-            if row.get('one_month_return', ''):
-                del row['one_month_return']
-            if row.get('six_months_return', ''):
-                del row['six_months_return']
+        rows_by_table[TABLE].append(row)
+
+    for TABLE, rows in rows_by_table.items():
+        insert_rows(TABLE, rows)
 
-        supabase.table(TABLE).insert(row).execute()
+
+def insert_rows(table, rows):
+    """
+    Insert rows into a table in chunks of INSERT_CHUNK_SIZE, one request per chunk.
+
+    Rows are upserted on `accessionNo` ignoring duplicates, so re-inserting an
+    already stored trade is a no-op (and doesn't reset its returns) instead of
+    failing the whole chunk. If a chunk is still rejected its rows are retried
+    one by one, so a single bad row doesn't drop the rest of the batch.
+    """
+    rows = iter(rows)
+    while chunk := list(islice(rows, INSERT_CHUNK_SIZE)):
+        try:
+            supabase.table(table).upsert(
+                chunk, on_conflict='accessionNo', ignore_duplicates=True).execute()
+        except Exception as e:
+            print(
+                f"Failed To Insert {len(chunk)} Rows Into {table} with exception: {str(e)}, retrying row by row", flush=True)
+            for row in chunk:
+                try:
+                    supabase.table(table).upsert(
+                        row, on_conflict='accessionNo', ignore_duplicates=True).execute()
+                except Exception as e:
+                    print(
+                        f"Failed To Insert accessionNo: {row['accessionNo']} Into {table} with exception: {str(e)}", flush=True)
 
 
 def get_trades_without_return(return_type):
@@ -380,10 +548,13 @@ def get_trades_without_return(return_type):
         column = "six_months_return"
         time = datetime.now() - timedelta(weeks=7)
 
-    res = supabase.table(PURCHASE_TABLE).select("*"
-                                                ).gt('disclosed_date', f"{time.isoformat()}"
-                                                     ).filter(f'{column}', 'is', 'null').limit(300
-                                                                                               ).order('disclosed_date', desc=True).execute()
+    # served by the partial `WHERE <column> IS NULL` indexes (see readme)
+    res = supabase.table(PURCHASE_TABLE).select("*") \
+        .gt('disclosed_date', f"{time.isoformat()}") \
+        .filter(column, 'is', 'null') \
+        .order('disclosed_date', desc=True) \
+        .limit(300) \
+        .execute()
     return res.data
 
 
@@ -408,9 +579,6 @@ def get_user_emails(email_type, **kwargs):
         T = Ticker Based (watchlist)
         A = Activity Based Notification
     """
-    def merge_result(list1, list2):
-        return [item for sublist in [list1, list2] for item in sublist]
-
     if email_type == 'D':
         resp = supabase.table(USERS_TABLE).select("id, email").eq(
             'settings -> daily_digest', 'true').eq('is_active', True).execute()
@@ -465,59 +633,84 @@ def get_user(user_id, columns=None):
 
 def get_users_for_notification(ticker, data):
     """
-    Reterieve WatchList Users, Activity Users, and Custom Notification Users
+    Reterieve WatchList Users, Activity Users, and Custom Notification Users with a
+    single call to the `get_all_notification_recipients` RPC (see readme), which
+    unions and de-duplicates the three groups in Postgres.
 
     Args:
         ticker (str): Ticker Of the Company
+        data (dict): The formatted trade, matched against the custom notifications.
 
     Returns:
         dict: A dict containing unique user emails and phone numbers to send signal
         notification email.
         Example : { emails: [], phones: [] }
     """
-    res = {
-        'emails': [],
-        'phones': []
-    }
-
     try:
-        watch_list_users = get_user_emails("T", ticker=ticker)
-        for entry in watch_list_users:
-            if entry['users']['watchlist_notification']['email_notification'] and entry['users']['email'] not in res['emails']:
-                res['emails'].append(entry['users']['email'])
-
-            if entry['users']['watchlist_notification']['text_notification'] and entry['users']['phone'] not in res['phones']:
-                res['phones'].append(entry['users']['phone'])
+        resp = supabase.rpc('get_all_notification_recipients', {
+                            'ticker': ticker, 'data': custom_notification_formatter(data)}).execute()
+        return split_recipients(resp.data)
     except Exception as e:
         print(
-            f'Failed To Get Users For watchlist notifications with exception: {str(e)}', flush=True)
+            f'Failed To Get Users For notifications with exception: {str(e)}', flush=True)
+        return split_recipients([])
 
-    try:
-        activity_users = get_user_emails("A")
-        for user in activity_users:
-            if user['settings']['email_notification'] and user['email'] not in res['emails']:
-                res['emails'].append(user['email'])
-            if user['settings']['text_notification'] and user['phone'] not in res['phones']:
-                res['phones'].append(user['phone'])
-    except Exception as e:
-        print(
-            f'Failed To Get Users For Activity notifications with exception: {str(e)}', flush=True)
 
+async def get_users_for_notification_async(client, ticker, data):
+    """
+    `get_users_for_notification` on the async Supabase client.
+
+    Args:
+        client (AsyncClient): See `get_async_supabase`.
+        ticker (str): Ticker Of the Company
+        data (dict): The formatted trade, matched against the custom notifications.
+    """
     try:
-        item = custom_notification_formatter(data)
-        print(item)
-        custom_resp = supabase.rpc('get_users_for_custom_notifications', {
-                                   'data': item}).execute()
-        for user in custom_resp.data:
-            if user['settings']['email_notification'] and user['email'] not in res['emails']:
-                res['emails'].append(user['email'])
-            if user['settings']['text_notification'] and user['phone'] not in res['phones']:
-                res['phones'].append(user['phone'])
+        resp = await client.rpc('get_all_notification_recipients', {
+                                'ticker': ticker, 'data': custom_notification_formatter(data)}).execute()
+        return split_recipients(resp.data)
     except Exception as e:
         print(
-            f'Failed To Get Users For Custom notifications with exception: {str(e)}', flush=True)
+            f'Failed To Get Users For notifications with exception: {str(e)}', flush=True)
+        return split_recipients([])
+
+
+def split_recipients(users):
+    """
+    Split the `get_all_notification_recipients` rows into unique emails and phones.
+
+    Returns:
+        dict: Example : { emails: [], phones: [] }
+    """
+    emails = set()
+    phones = set()
+
+    for user in users:
+        if user['email_notification']:
+            emails.add(user['email'])
+        if user['text_notification']:
+            phones.add(user['phone'])
+
+    return {
+        'emails': list(emails),
+        'phones': list(phones)
+    }
+
+
+async def get_users_for_notifications_batch_async(items):
+    """
+    `get_users_for_notification` for a list of trades, with the RPC of every trade
+    in flight at once so a batch takes about as long as its slowest call.
+
+    Args:
+        items (list): Formatted trades, each with at least a 'ticker' key.
 
-    return res
+    Returns:
+        list: One { emails: [], phones: [] } dict per item, in the same order.
+    """
+    client = await get_async_supabase()
+    return await asyncio.gather(*(
+        get_users_for_notification_async(client, data['ticker'], data) for data in items))
 
 
 def get_ticker_track_record(ticker):
@@ -531,9 +724,35 @@ def get_ticker_track_record(ticker):
         list: A list containing the data for the latest 5 purchase and sale transactions.
               Each transaction is represented as a dictionary with details like disclosed_date, sector, etc.
     """
-    resp_p = supabase.table(get_database_table("p")).select(
-        "*").eq('ticker', ticker).limit(5).order('disclosed_date', desc=True).execute()
-    resp_s = supabase.table(get_database_table("s")).select(
-        "*").eq('ticker', ticker).limit(5).order('disclosed_date', desc=True).execute()
+    resp = supabase.rpc('ticker_track_record', {
+                        'tickers': [ticker], 'lim': 5}).execute()
+    return resp.data
+
+
+async def get_ticker_track_record_batch_async(tickers, limit=5):
+    """
+    Batched `get_ticker_track_record` on the async Supabase client, a single call
+    to the `ticker_track_record` RPC (see readme) which reads both trade tables in
+    one query plan.
+
+    Args:
+        tickers (iterable): The ticker symbols.
+        limit (int): Number of latest purchase and sale transactions kept per ticker.
+
+    Returns:
+        dict: ticker -> list of its latest purchase then sale transactions.
+    """
+    tickers = list(tickers)
+    client = await get_async_supabase()
+    resp = await client.rpc('ticker_track_record', {
+                            'tickers': tickers, 'lim': limit}).execute()
+    return group_track_records(tickers, resp.data)
+
+
+def group_track_records(tickers, rows):
+    # rows come ordered purchases first, then sales, latest first
+    track_records = {ticker: [] for ticker in tickers}
+    for row in rows:
+        track_records[row['ticker']].append(row)
 
-    return resp_p.data + resp_s.data
+    return track_records
@@ -1,10 +1,14 @@
+import os
+import numpy as np
 import yfinance as yf
-from collections import Counter
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
 from itertools import groupby
 from workalendar.usa import UnitedStates
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from .formatters import get_sector, get_market_cap
+from .redis_helper import get_cached_prices, cache_prices
 
 
 # ============================================
@@ -12,6 +16,12 @@ from .formatters import get_sector, get_market_cap
 #                 Helpers
 # ============================================
 # ============================================
+# days after the disclosed date of the one week, one month and six months returns
+RETURN_PERIODS = (7, 30, 180)
+# tickers `fetch_prices_bulk` downloads at the same time
+PRICE_DOWNLOAD_THREADS = 16
+
+
 def download_stock_data(ticker, start_date, end_date):
     return yf.download(ticker, start=start_date, end=end_date, threads=True)
 
@@ -35,23 +45,8 @@ def calculate_return(purchase_price, current_price, number_of_shares):
 
 
 def calculate_returns(ticker, disclosed_date, total_shares, share_price):
-    # Helper function to get the next weekday
-    def get_next_business_day(calendar, date):
-        while not calendar.is_working_day(date):
-            date += timedelta(days=1)
-        return date
-
     # Convert disclosed_date to datetime
     start_date = datetime.fromisoformat(disclosed_date)
-    calendar = UnitedStates()
-
-    # Calculate end dates
-    start_date_week = get_next_business_day(
-        calendar, start_date + timedelta(days=7)).strftime("%Y-%m-%d")
-    start_date_month = get_next_business_day(
-        calendar, start_date + timedelta(days=30)).strftime("%Y-%m-%d")
-    start_date_six_months = get_next_business_day(
-        calendar, start_date + timedelta(days=180)).strftime("%Y-%m-%d")
 
     # Use Yahoo Finance to download historical stock prices
     # print('working fine', ticker)
@@ -59,12 +54,161 @@ def calculate_returns(ticker, disclosed_date, total_shares, share_price):
     data = download_stock_data(ticker, start_date.strftime(
         "%Y-%m-%d"), (start_date + timedelta(days=190)).strftime("%Y-%m-%d"))
 
+    return returns_from_prices(data['Adj Close'], start_date, get_return_dates([start_date])[0],
+                               total_shares, share_price)
+
+
+def calculate_returns_batch(trades):
+    """
+    Batched `calculate_returns`, the prices of every ticker are fetched with a
+    single multi-ticker `yf.download` spanning all the trades instead of one
+    request per trade. Closes are cached in Redis per (ticker, date), so the
+    tickers whose closes up to today are all cached aren't downloaded at all.
+
+    Args:
+        trades (list): Trades with 'ticker', 'disclosed_date', 'total_shares' and
+                       'share_price' keys, e.g. the rows of `get_trades_without_return`.
+
+    Returns:
+        list: One returns dict per trade, in the same order.
+        Example : [{ one_week_return: 1.2, one_month_return: None, six_months_return: None }]
+    """
+    if not trades:
+        return []
+
+    start_dates = [datetime.fromisoformat(trade['disclosed_date'])
+                   for trade in trades]
+    trade_dates = [[start_date.strftime("%Y-%m-%d")] + return_dates
+                   for start_date, return_dates in zip(start_dates, get_return_dates(start_dates))]
+
+    # closes needed by every trade, served from the Redis cache when possible
+    # and only the tickers with a missing close are downloaded
+    wanted = {(trade['ticker'], date)
+              for trade, dates in zip(trades, trade_dates) for date in dates}
+    prices = get_cached_prices(wanted)
+
+    # only past working days are sure to have a close, the later return dates
+    # (six months, often one month) have none yet and mustn't force a download
+    today = datetime.now().strftime("%Y-%m-%d")
+    past_dates = sorted({date for _, date in wanted if date < today})
+    calendar = get_business_day_calendar(
+        min(start_dates).year, max(start_dates).year + 2)
+    trading_days = {date for date, is_busday in zip(
+        past_dates, np.is_busday(np.array(past_dates, dtype='datetime64[D]'), busdaycal=calendar)) if is_busday}
+    missing_tickers = {ticker for ticker, date in wanted
+                       if date in trading_days and (ticker, date) not in prices}
+
+    if missing_tickers:
+        downloaded = fetch_prices_bulk(missing_tickers,
+                                       min(start_dates).strftime("%Y-%m-%d"),
+                                       (max(start_dates) + timedelta(days=190)).strftime("%Y-%m-%d"))
+        closes = {ticker: {date.strftime("%Y-%m-%d"): float(price) for date, price in series.items()}
+                  for ticker, series in downloaded.items() if series is not None}
+        fresh = {(ticker, date): closes[ticker][date] for ticker, date in wanted
+                 if ticker in closes and date in closes[ticker]}
+        cache_prices(fresh)
+        prices.update(fresh)
+
+    return [
+        returns_from_prices({date: prices[(trade['ticker'], date)] for date in dates
+                             if (trade['ticker'], date) in prices},
+                            start_date, dates[1:], trade['total_shares'], trade['share_price'])
+        for trade, start_date, dates in zip(trades, start_dates, trade_dates)
+    ]
+
+
+def fetch_prices_bulk(tickers, start_date, end_date):
+    """
+    Adjusted closing prices of many tickers with a single multi-ticker `yf.download`.
+
+    Args:
+        tickers (iterable): The ticker symbols.
+        start_date (str): First day, "%Y-%m-%d".
+        end_date (str): Day after the last day, "%Y-%m-%d".
+
+    Returns:
+        dict: ticker -> pandas.Series of its adjusted closes indexed by date, None
+        for the tickers Yahoo Finance returned nothing for.
+    """
+    tickers = sorted(tickers)
+    # yfinance fetches each ticker with its own request, `threads` runs that many
+    # of them at once
+    data = yf.download(' '.join(tickers), start=start_date, end=end_date,
+                       group_by='ticker', threads=PRICE_DOWNLOAD_THREADS, progress=False)
+
+    prices = {}
+    for ticker in tickers:
+        # a single ticker download comes back without the ticker column level
+        if len(tickers) == 1:
+            series = data['Adj Close'] if 'Adj Close' in data else None
+        elif ticker in data.columns.get_level_values(0):
+            series = data[ticker]['Adj Close']
+        else:
+            series = None
+
+        # the frame spans the dates of every ticker, drop the ones this ticker
+        # didn't trade on so lookups fall back like a single ticker download
+        prices[ticker] = series.dropna() if series is not None else None
+
+    return prices
+
+
+@lru_cache(maxsize=8)
+def get_business_day_calendar(first_year, last_year):
+    """
+    US working days (weekdays minus the workalendar `UnitedStates` holidays) from
+    `first_year` to `last_year`, as a numpy busdaycalendar.
+    """
+    calendar = UnitedStates()
+    holidays = [day for year in range(first_year, last_year + 1)
+                for day, _ in calendar.holidays(year)]
+    return np.busdaycalendar(holidays=holidays)
+
+
+def get_return_dates(start_dates):
+    """
+    Dates of the one week, one month and six months returns of each start date,
+    i.e. start date + RETURN_PERIODS rolled forward to the next working day, all
+    rolled in a single `np.busday_offset` call.
+
+    Args:
+        start_dates (list): datetime objects.
+
+    Returns:
+        list: One [week, month, six months] list of "%Y-%m-%d" strings per start date.
+    """
+    starts = np.array([date.date() for date in start_dates], dtype='datetime64[D]')
+    targets = starts[:, None] + np.array(RETURN_PERIODS, dtype='timedelta64[D]')
+
+    # one extra year so the six months date can roll over new year's day
+    calendar = get_business_day_calendar(
+        min(start_dates).year, max(start_dates).year + 2)
+    return np.busday_offset(targets, 0, roll='forward', busdaycal=calendar).astype(str).tolist()
+
+
+def returns_from_prices(adj_close, start_date, return_dates, total_shares, share_price):
+    """
+    Returns of a trade one week, one month and six months after `start_date`.
+
+    Args:
+        adj_close (pandas.Series or dict): Adjusted closing prices indexed by date.
+        start_date (datetime): The disclosed date of the trade.
+        return_dates (list): The week, month and six months dates, see `get_return_dates`.
+        total_shares (int): Number of shares traded.
+        share_price (float): Fallback price when `start_date` has no close.
+
+    Returns:
+        dict: { one_week_return, one_month_return, six_months_return }, None when
+        there is no close for that date (yet).
+    """
+    start_date_week, start_date_month, start_date_six_months = return_dates
+
     # Extract adjusted closing prices for the relevant times
-    share_price = data['Adj Close'].get(
+    share_price = adj_close.get(
         start_date.strftime("%Y-%m-%d"), share_price)
-    closing_price_week = data['Adj Close'].get(start_date_week, None)
-    closing_price_month = data['Adj Close'].get(start_date_month, None)
-    closing_price_six_months = data['Adj Close'].get(
+    closing_price_week = adj_close.get(start_date_week, None)
+    closing_price_month = adj_close.get(start_date_month, None)
+    closing_price_six_months = adj_close.get(
         start_date_six_months, None)
 
     # Calculate returns
@@ -85,53 +229,72 @@ def extract_last_item(group):
     return group[-1].get('sharesOwnedFollowingTransaction', 0) if group else 0
 
 
-def get_transaction_coding(transactions):
-    codings = [transaction['coding']['code'] for transaction in transactions]
-    counts = Counter(codings)
-    most_common = counts.most_common(1)
-    if most_common:
-        return most_common[0][0]
-    else:
-        return None
+def group_transaction_by_coding(transactions):
+    """
+    Group the transactions of a filing by their coding code, in a single pass.
 
+    Args:
+        transactions (list): The filing's nonDerivativeTable transactions.
 
-def group_transaction_by_coding(transactions):
-    combined_transactions = {}
+    Returns:
+        tuple: A tuple containing three elements:
+            - dict: coding code -> its transactions, in filing order.
+            - list: The coding code of every transaction.
+            - str or None: The most common coding code, None without transactions.
+    """
+    combined_transactions = defaultdict(list)
+    codings = []
 
     for transaction in transactions:
         coding_code = transaction['coding']['code']
+        codings.append(coding_code)
+        combined_transactions[coding_code].append(transaction)
 
-        # If the coding code is not in the combined_transactions dictionary, create a new entry
-        if coding_code not in combined_transactions:
-            combined_transactions[coding_code] = []
+    most_common = Counter(codings).most_common(1)
+    return combined_transactions, codings, most_common[0][0] if most_common else None
 
-        combined_transactions[coding_code].append(transaction)
-    return combined_transactions
 
+def get_subscription_amount(subscription):
+    """
+    Price of a subscription's first item formatted as "%.2f", None without one.
 
-def get_all_codings(transactions):
-    codings = [transaction['coding']['code'] for transaction in transactions]
-    return codings
+    Read from `items.data[0].price`, the legacy `plan` field is deprecated.
+    """
+    items = (subscription.get('items') or {}).get('data') or []
+    price = (items[0].get('price') or {}) if items else {}
+    if price.get('unit_amount') is not None:
+        return '{:.2f}'.format(price['unit_amount'] / 100)
+    return None
 
 
 def retrieve_subscription_amount(stripe, subscription_id):
     try:
         subscription = stripe.Subscription.retrieve(subscription_id)
-        plan = subscription.get('plan', {})
-        if 'amount' in plan:
-            return '{:.2f}'.format(plan['amount'] / 100)
+        return get_subscription_amount(subscription)
     except stripe.error.StripeError as e:
         print(f"Error retrieving subscription: {e}")
     return None
 
 
+def get_object_id(obj):
+    """
+    Get the id of an expandable Stripe field, which holds either the id
+    itself or the expanded object.
+    """
+    if obj is None or isinstance(obj, str):
+        return obj
+    return obj['id']
+
+
 def calculate_amount(stripe, session):
     amount = None
 
     if session.get('mode') == 'subscription':
-        subscription_id = session.get('subscription')
-        if isinstance(subscription_id, str):
-            amount = retrieve_subscription_amount(stripe, subscription_id)
+        subscription = session.get('subscription')
+        if isinstance(subscription, str):
+            amount = retrieve_subscription_amount(stripe, subscription)
+        elif subscription:
+            amount = get_subscription_amount(subscription)
     elif session.get('mode') == 'payment':
         total_amount = session.get('amount_total')
         if isinstance(total_amount, int):
@@ -145,7 +308,46 @@ def calculate_amount(stripe, session):
 #                Main Functions
 # ============================================
 # ============================================
-def extract_insider_trades_info_single(insider_trade, returns=False):
+def extract_filing_fields(insider_trade, ticker, ceo_name, company_name):
+    """
+    Fields shared by every trade of a filing, copied into each of its trades by
+    `extract_insider_trades_info_single`.
+
+    Returns:
+        tuple: The shared fields dict and the shares held outside the
+        transactions (nonDerivativeTable holdings).
+    """
+    filing = {
+        "filling": insider_trade["id"],
+        "ticker": ticker,
+        "cik": insider_trade['issuer']['cik'],
+        "q": f"{ceo_name} - {company_name}",
+        "sector": get_sector(ticker),
+        "market_cap": get_market_cap(ticker),
+        "accessionNo": insider_trade['accessionNo'],
+        "periodOfReport": insider_trade['periodOfReport'],
+        "ceo_name": ceo_name,
+        "company_name": company_name,
+        "share_price": insider_trade["nonDerivativeTable"]["transactions"][0]["amounts"].get(
+            "pricePerShare", 0),
+        "disclosed_date": insider_trade["filedAt"],
+        "link": insider_trade.get('link', None),
+        'one_week_return': None,
+        'one_month_return': None,
+        'six_months_return': None
+    }
+
+    holdings_shares = 0
+    if insider_trade["nonDerivativeTable"].get('holdings', False):
+        if isinstance(insider_trade['nonDerivativeTable']['holdings'], list):
+            for x in insider_trade['nonDerivativeTable']['holdings']:
+                if "postTransactionAmounts" in x and "sharesOwnedFollowingTransaction" in x['postTransactionAmounts']:
+                    holdings_shares += x["postTransactionAmounts"]["sharesOwnedFollowingTransaction"]
+
+    return filing, holdings_shares
+
+
+def extract_insider_trades_info_single(insider_trade, returns=False, groups=None):
     ticker = insider_trade["issuer"]["tradingSymbol"]
     ceo_name = insider_trade["reportingOwner"]["name"]
     company_name = insider_trade["issuer"]["name"]
@@ -153,9 +355,21 @@ def extract_insider_trades_info_single(insider_trade, returns=False):
     total_amount_spent = 0
     results = []
 
+    # built on the first purchase or sale, other filings never need it
+    filing = None
+    holdings_shares = 0
+
+    # callers that already grouped the transactions can pass them in
+    if groups is None:
+        groups, _, _ = group_transaction_by_coding(
+            insider_trade["nonDerivativeTable"]["transactions"])
+
     # for transaction in transactions:
-    for code, transactions in group_transaction_by_coding(insider_trade["nonDerivativeTable"]["transactions"]).items():
+    for code, transactions in groups.items():
         if code in ["P", "S"]:
+            if filing is None:
+                filing, holdings_shares = extract_filing_fields(
+                    insider_trade, ticker, ceo_name, company_name)
             grouped_transactions = {'D': [], 'indirect': {}}
 
             for transaction in transactions:
@@ -186,57 +400,61 @@ def extract_insider_trades_info_single(insider_trade, returns=False):
                 nested_group) for key, nested_group in grouped_transactions['indirect'].items()}
             last_items_combined = [last_items_d] + \
                 list(last_items_indirect.values())
-            total_shares_after_purchase = sum(last_items_combined)
-
-            disclosed_date = insider_trade["filedAt"]
-            share_price = insider_trade["nonDerivativeTable"]["transactions"][0]["amounts"].get(
-                "pricePerShare", 0)
-
-            if insider_trade["nonDerivativeTable"].get('holdings', False):
-                if isinstance(insider_trade['nonDerivativeTable']['holdings'], list):
-                    for x in insider_trade['nonDerivativeTable']['holdings']:
-                        if "postTransactionAmounts" in x and "sharesOwnedFollowingTransaction" in x['postTransactionAmounts']:
-                            total_shares_after_purchase += x["postTransactionAmounts"]["sharesOwnedFollowingTransaction"]
+            total_shares_after_purchase = sum(
+                last_items_combined) + holdings_shares
 
             change_in_shares_percentage = (
                 total_shares / total_shares_after_purchase) * 100 if total_shares_after_purchase != 0 else 0
 
-            trade_returns = {'one_week_return': None,
-                             'one_month_return': None, 'six_months_return': None}
-
             results.append({
-                "filling": insider_trade["id"],
-                "ticker": ticker,
-                "cik": insider_trade['issuer']['cik'],
-                "q": f"{ceo_name} - {company_name}",
-                "sector": get_sector(ticker),
-                "market_cap": get_market_cap(ticker),
-                "accessionNo": insider_trade['accessionNo'],
-                "periodOfReport": insider_trade['periodOfReport'],
+                **filing,
                 "transaction_type": code,
-                "ceo_name": ceo_name,
-                "company_name": company_name,
                 "total_shares": total_shares,
-                "share_price": share_price,
-                "disclosed_date": disclosed_date,
                 "total_amount_spent": total_amount_spent,
                 "total_shares_after_transaction": total_shares_after_purchase,
-                "link": insider_trade.get('link', None),
                 "change_in_shares_percentage": round(change_in_shares_percentage, 4),
-                **trade_returns
             })
     return results
 
 
-def extract_insider_trades_info_parallel(data, **kwargs):
+def extract_insider_trades_info_safe(insider_trade):
+    # top level so the process pool can pickle it
+    try:
+        return extract_insider_trades_info_single(insider_trade)
+    except Exception as e:
+        print(f"Exception in parallel processing: {e}", flush=True)
+        return []
+
+
+def extract_insider_trades_info_parallel(data, max_workers=None, **kwargs):
+    """
+    `extract_insider_trades_info_single` over many filings in a process pool, the
+    work is pure Python (sector and market cap are in-memory lookups) so threads
+    would just take turns on the GIL.
+
+    Args:
+        data (list): Insider trade filings.
+        max_workers (int or None): Optional. Number of processes, defaults to the
+                                   number of CPUs.
+
+    Returns:
+        list: The extracted trades of every filing, flattened. Filings that fail
+        to parse are logged and skipped, repeated filings (same accessionNo) are
+        only extracted once.
+    """
+    seen = set()
+    unique_data = []
+    for insider_trade in data:
+        accession_no = insider_trade.get('accessionNo')
+        if accession_no is not None:
+            if accession_no in seen:
+                continue
+            seen.add(accession_no)
+        unique_data.append(insider_trade)
+
     result = []
-    max_workers = 10
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(
-            extract_insider_trades_info_single, insider_trade) for insider_trade in data]
-        for future in futures:
-            try:
-                result.append(future.result())
-            except Exception as e:
-                print(f"Exception in parallel processing: {e}")
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        # chunks of filings per task to amortize the pickling round trips
+        for trades in executor.map(extract_insider_trades_info_safe, unique_data, chunksize=8):
+            result.extend(trades)
     return result
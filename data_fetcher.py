@@ -1,10 +1,65 @@
-import json
+import orjson
 import sys
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from app.internals.utils import extract_insider_trades_info_parallel, calculate_returns, extract_insider_trades_info_single
 from app.app import insiderTradingApi, queryApi
 
 args = sys.argv[1:]
+MAX_WORKERS = 8
+# one trade per line (JSONL), read back with
+# [orjson.loads(line) for line in open(OUTPUT_FILE, 'rb')]
+OUTPUT_FILE = f'json_data/purchase/{args[0]}.jsonl'
+
+# Parts of the queries that are the same for the whole run, built once. Each
+# request only fills in the accession numbers or the page offset.
+FILINGS_BASE_QUERY = {
+    "from": "0",
+    "sort": [{"filedAt": {"order": "desc"}}]
+}
+TRADES_BASE_QUERY = {
+    "query": {
+        "query_string": {
+            "query": f"reportingOwner.relationship.officerTitle:CEO* AND nonDerivativeTable.transactions.coding.code:P AND periodOfReport:[{args[0]}-01-01 TO {args[0]}-12-31]"
+        },
+    },
+    "sort": [{"filedAt": {"order": "desc"}}]
+}
+
+
+def filing_key(item):
+    return item['issuer']['tradingSymbol'], item['accessionNo']
+
+
+def fetch_filings(items, api_instance):
+    """
+    Look up the filings of the given insider trades with a single query-API call,
+    OR-ing the `ticker AND accessionNo` condition of every trade (the same pairing
+    `make_request` uses, a filing can cover several issuers).
+
+    Returns:
+        dict: (ticker, accessionNo) -> its latest filing.
+    """
+    pairs = {filing_key(item) for item in items}
+    query = {
+        **FILINGS_BASE_QUERY,
+        "query": {
+            "query_string": {
+                "query": " OR ".join(f'(ticker:{ticker} AND accessionNo:"{accession_no}")'
+                                     for ticker, accession_no in sorted(pairs))
+            }
+        },
+        "size": str(len(pairs))
+    }
+
+    result = api_instance.get_filings(query)
+
+    filings = {}
+    for filing in result.get('filings', []):
+        key = (filing.get('ticker'), filing['accessionNo'])
+        # sorted latest first, keep the first one like the per-trade lookup did
+        if key in pairs:
+            filings.setdefault(key, filing)
+    return filings
 
 
 def make_request(item, api_instance):
@@ -23,52 +78,72 @@ def make_request(item, api_instance):
     return item, result
 
 
-if not os.path.isfile(f'json_data/purchase/{args[0]}.json'):
-    # If it doesn't exist, create the file with an empty array
-    with open(f'json_data/purchase/{args[0]}.json', 'w') as json_file:
-        empty_array = []
-        json.dump(empty_array, json_file)
+def fetch_filings_parallel(items, api_instance):
+    """
+    Fallback for `fetch_filings`, one query-API call per trade spread over a thread
+    pool (the SEC API client rate limits and retries the calls, see sec_helper).
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - list: The trades whose lookup succeeded.
+            - dict: (ticker, accessionNo) -> its latest filing.
+    """
+    looked_up = []
+    filings = {}
 
-with open('json_data/ticker_keys.json', 'r') as test:
-    tickers = json.load(test)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(make_request, item, api_instance)
+                   for item in items]
+
+        for future in as_completed(futures):
+            try:
+                item, result = future.result()
+            except Exception as e:
+                print(e)
+                continue
+
+            looked_up.append(item)
+            found = result.get('filings', [])
+            if len(found):
+                filings[filing_key(item)] = found[0]
+
+    return looked_up, filings
+
+
+with open('json_data/ticker_keys.json', 'rb') as test:
+    # a set for O(1) membership checks, works for a list or a dict of tickers
+    tickers = set(orjson.loads(test.read()))
 
 api_instance = queryApi
 offset = int(args[1])
 size = 50
-while True:
-    query = {
-        "query": {
-            "query_string": {
-                "query": f"reportingOwner.relationship.officerTitle:CEO* AND nonDerivativeTable.transactions.coding.code:P AND periodOfReport:[{args[0]}-01-01 TO {args[0]}-12-31]"
-            },
-        },
-        "from": offset,
-        "size": size,
-        "sort": [{"filedAt": {"order": "desc"}}]
-    }
-
-    insider_trades = insiderTradingApi.get_data(query)
-    final_list = []
-    for item in insider_trades["transactions"]:
-        if item['issuer']['tradingSymbol'] in tickers:
+# Append each page to the output file, a crash only loses the page in flight
+with open(OUTPUT_FILE, 'ab') as out:
+    while True:
+        query = {**TRADES_BASE_QUERY, "from": offset, "size": size}
+
+        insider_trades = insiderTradingApi.get_data(query)
+        items = [item for item in insider_trades["transactions"]
+                 if item['issuer']['tradingSymbol'] in tickers]
+        final_list = []
+
+        try:
+            filings = fetch_filings(items, api_instance) if items else {}
+        except Exception as e:
+            print(f'Batched filing lookup failed: {e}, looking up one by one')
+            items, filings = fetch_filings_parallel(items, api_instance)
+
+        for item in items:
             try:
                 print(item['issuer']['tradingSymbol'])
-                item, result = make_request(item, api_instance)
-
-                filings = result.get('filings', [])
+                filing = filings.get(filing_key(item))
 
-                if len(filings):
-                    item['link'] = filings[0]['linkToFilingDetails']
-                    item['cik'] = filings[0]['cik']
-
-                    if filings[0]['formType'] == "4":
-                        item['form_type'] = filings[0]['formType']
-                        print('Correct Data: ',
-                              item['issuer']['tradingSymbol'])
-                    else:
-                        item['form_type'] = filings[0]['formType']
-                        print('Correct Data: ',
-                              item['issuer']['tradingSymbol'])
+                if filing is not None:
+                    item['link'] = filing['linkToFilingDetails']
+                    item['cik'] = filing['cik']
+                    item['form_type'] = filing['formType']
+                    print('Correct Data: ',
+                          item['issuer']['tradingSymbol'])
 
                 final_list.append(item)
 
@@ -76,22 +151,19 @@ while True:
                 print(e)
                 continue
 
-    with open(f'json_data/purchase/{args[0]}.json', 'r') as test:
-        x = json.load(test)
-        x = x + final_list
-
-    with open(f'json_data/purchase/{args[0]}.json', 'w') as json_file:
-        json.dump(x, json_file, indent=4)
+        for item in final_list:
+            out.write(orjson.dumps(item) + b"\n")
+        out.flush()
 
-    total = insider_trades['total']
-    offset += size
+        total = insider_trades['total']
+        offset += size
 
-    if total['value'] <= size:
-        break
+        if total['value'] <= size:
+            break
 
-    if total['value'] < offset:
-        break
+        if total['value'] < offset:
+            break
 
-    print('offset = ', offset)
-    print('size = ', size)
-    print('total = ', total['value'])
+        print('offset = ', offset)
+        print('size = ', size)
+        print('total = ', total['value'])
@@ -1,177 +1,274 @@
 ﻿import socketio
+import os
+import queue
+import logging
 import asyncio
-import websockets
+import uvloop
+import aiohttp
 import time
-import json
-from app.internals.utils import extract_insider_trades_info_single, get_all_codings
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from app.internals.utils import extract_insider_trades_info_single, group_transaction_by_coding
 from app.internals.resend_helper import signal_notification
 from app.internals.constants import sectors_with_ticker, officer_titles
 from app.internals.supabase_helper import insert_data_into_table
 from app.app import SEC_API_KEY, insiderTradingApi
 
 API_KEY = SEC_API_KEY
+# STREAM_LOG_LEVEL=WARNING turns the per filing info logs into no-ops
+LOG_LEVEL = os.getenv('STREAM_LOG_LEVEL', 'INFO')
 SERVER_URL = "wss://stream.sec-api.io"
 
 WS_ENDPOINT = SERVER_URL + "?apiKey=" + API_KEY
+# frames processed at the same time, the rest wait for a free slot
+FILINGS_CONCURRENCY = 32
+# largest page the insider trading API returns
+INSIDER_TRADES_PAGE_SIZE = 50
 
+# strong references to the running frame tasks, the event loop only keeps weak ones
+filing_tasks = set()
 
-async def fetch_insider_trades(accessionNo, ticker, link):
-    await asyncio.sleep(15)  # Introduce a delay of 15 seconds
-    insider_trades = insiderTradingApi.get_data({
+# seconds to wait before each insider trade lookup, the trade usually shows up
+# in the insider trading index shortly after the filing is streamed
+INDEX_POLL_DELAYS = (0, 2, 5, 10)
+
+# trades waiting to be inserted, flushed in one insert every INSERT_FLUSH_INTERVAL
+# seconds so a burst of filings doesn't cost a round trip each (created in main)
+INSERT_FLUSH_INTERVAL = 0.5
+insert_queue = None
+
+# the SEC API and Supabase insert clients are blocking, their calls run here so
+# they don't stall the websocket receive loop
+blocking_executor = ThreadPoolExecutor(max_workers=16)
+
+
+log = logging.getLogger("stream")
+
+
+def setup_logging():
+    """
+    Log through a QueueHandler. The message is still %-formatted on the event
+    loop (`QueueHandler.prepare`), but the write to stdout happens in a
+    QueueListener thread, so a slow stdout can't stall the receive loop.
+
+    Returns:
+        QueueListener: The started listener, stop it to flush the queue.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(message)s"))
+
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, fn, *args)
+
+
+async def flush_inserts():
+    batch = []
+    while not insert_queue.empty():
+        batch.extend(insert_queue.get_nowait())
+
+    if batch:
+        try:
+            log.info("inserting %d trades into trade table", len(batch))
+            await run_blocking(insert_data_into_table, batch)
+
+        except Exception as e:
+            log.error("failed to insert %d trades: %s", len(batch), e)
+
+
+async def insert_flusher():
+    while True:
+        await asyncio.sleep(INSERT_FLUSH_INTERVAL)
+        await flush_inserts()
+
+
+def get_insider_trades_query(accession_nos):
+    return {
         "query": {
             "query_string": {
-                "query": f"accessionNo:{accessionNo}"
+                "query": "accessionNo:(" + " OR ".join(f'"{accession_no}"' for accession_no in accession_nos) + ")"
             },
         },
         "from": 0,
-        "size": 1,
+        "size": len(accession_nos),
         "sort": [{"filedAt": {"order": "desc"}}]
-    })
-
-    print("====================================")
-    print("====================================")
-    print(
-        f"FETCHED {insider_trades['total']['value']} RECORDS FROM INSIDER TRADE API FOR TICKER = {ticker}")
-
-    if insider_trades['total']['value']:
-        data = insider_trades['transactions'][0]
-        is_officer = data.get('reportingOwner', {}).get(
-            'relationship', {}).get('isOfficer', False)
-
-        if is_officer:
-            officer_title = data.get('reportingOwner', {}).get(
-                'relationship', {}).get('officerTitle', "")
-            codings = get_all_codings(
-                data["nonDerivativeTable"]["transactions"])
-            is_sale_or_purchase = "P" in codings or "S" in codings
-
-            if (officer_title.find("CEO") != -1 or officer_title in officer_titles) and is_sale_or_purchase:
-                print("====================================")
-                print("====================================")
-                print("FOUND A TRADE MADE BY A CEO")
-                print("====================================")
-                print("====================================")
-                formated_data = extract_insider_trades_info_single(data)
-                for d in formated_data:
-                    d['link'] = link
-
-                try:
-                    print("====================================")
-                    print("====================================")
-                    print("SENDING NOTIFICATION TO USERS")
-                    signal_notification(formated_data)
-
-                except Exception as e:
-                    print(
-                        f"Failed To Send Notifcation For accessionNo: {accessionNo}")
-
-                try:
-                    print("====================================")
-                    print("====================================")
-                    print("INSERTING DATA INTO TRADE TABLE")
-                    insert_data_into_table(formated_data)
-
-                except Exception as e:
-                    print(
-                        f"Failed To Insert Data for : accessionNo: {accessionNo}")
-
-            else:
-                print("====================================")
-                print("====================================")
-                print(
-                    f"THIS TRADE WAS MADE BY {officer_title} WITH CODING = {codings}, SO SKIPPING!")
-                print("====================================")
-                print("====================================")
-        else:
-            print("====================================")
-            print("====================================")
-            print(f"THIS TRADE WAS NOT MADE BY A OFFICER, SO SKIPPING!")
-            print("====================================")
-            print("====================================")
+    }
+
+
+async def fetch_insider_trades_batch(filings):
+    """
+    Fetch the insider trades of a frame's form 4 filings, one OR'd accessionNo
+    query per poll (and INSIDER_TRADES_PAGE_SIZE filings) instead of one per
+    filing, then process the trades concurrently.
+    """
+    filings_by_accession = {
+        filing['accessionNo']: filing for filing in filings}
+    pending = set(filings_by_accession)
+    found = {}
 
+    # Poll until the trades are indexed instead of always waiting the worst case
+    for delay in INDEX_POLL_DELAYS:
+        await asyncio.sleep(delay)
+        accession_nos = sorted(pending)
+        for i in range(0, len(accession_nos), INSIDER_TRADES_PAGE_SIZE):
+            page = accession_nos[i:i + INSIDER_TRADES_PAGE_SIZE]
+            try:
+                insider_trades = await run_blocking(insiderTradingApi.get_data,
+                                                    get_insider_trades_query(page))
+            except Exception as e:
+                # the page's filings stay pending for the next poll, the
+                # trades found so far are still processed
+                log.error("insider trade api failed for %d filings: %s",
+                          len(page), e)
+                continue
+
+            # sorted latest first, keep the first trade of each filing
+            for data in insider_trades['transactions']:
+                if data.get('accessionNo') in pending:
+                    found[data['accessionNo']] = data
+                    pending.discard(data['accessionNo'])
+
+        if not pending:
+            break
+
+    log.info("fetched %d records from insider trade api for %d filings",
+             len(found), len(filings_by_accession))
+
+    for accessionNo in pending:
+        log.warning("got no response for accessionNo %s with ticker %s",
+                    accessionNo, filings_by_accession[accessionNo].get('ticker', ''))
+
+    results = await asyncio.gather(*(
+        process_insider_trade(data, accessionNo,
+                              filings_by_accession[accessionNo].get('linkToFilingDetails', ""))
+        for accessionNo, data in found.items()), return_exceptions=True)
+
+    for accessionNo, result in zip(found, results):
+        if isinstance(result, Exception):
+            log.error("process failed for accessionNo %s: %s",
+                      accessionNo, result)
+
+
+async def process_insider_trade(data, accessionNo, link):
+    is_officer = data.get('reportingOwner', {}).get(
+        'relationship', {}).get('isOfficer', False)
+
+    if is_officer:
+        officer_title = data.get('reportingOwner', {}).get(
+            'relationship', {}).get('officerTitle', "")
+        groups, codings, _ = group_transaction_by_coding(
+            data["nonDerivativeTable"]["transactions"])
+        is_sale_or_purchase = "P" in groups or "S" in groups
+
+        if (officer_title.find("CEO") != -1 or officer_title in officer_titles) and is_sale_or_purchase:
+            log.info("found a trade made by a CEO, accessionNo %s", accessionNo)
+            formated_data = extract_insider_trades_info_single(
+                data, groups=groups)
+            for d in formated_data:
+                d['link'] = link
+
+            try:
+                log.info("sending notification to users")
+                await signal_notification(formated_data)
+
+            except Exception as e:
+                log.error("failed to send notification for accessionNo %s: %s",
+                          accessionNo, e)
+
+            # inserted by insert_flusher with the other queued trades
+            insert_queue.put_nowait(formated_data)
+
+        else:
+            log.info("trade made by %s with coding %s, skipping",
+                     officer_title, codings)
     else:
-        print("====================================")
-        print("====================================")
-        print(
-            f"GOT NO RESPONSE FOR THAT PARTICULAR ACCESSION-NUMBER = {accessionNo} WITH TICKER {ticker}")
-        print("====================================")
-        print("====================================")
+        log.info("trade not made by an officer, skipping")
 
 
-async def on_filings(filing):
+async def on_filings(filings, semaphore):
     try:
-        form_type = filing.get('formType', "")
-        ticker = filing.get('ticker', "")
-        company_name = filing.get('companyName', "")
-        accessionNo = filing.get('accessionNo', "")
-        link = filing.get('linkToFilingDetails', "")
-
-        if form_type in ["4", "4/A"] and accessionNo:
-            print("====================================")
-            print("====================================")
-            print(
-                f"JUST GOT A FORM TYPE 4 TRADE FOR TICKER {ticker} WITH NAME {company_name}")
-            print("====================================")
-            print("====================================")
-
-            # Call the fetch_insider_trades coroutine
-            await fetch_insider_trades(accessionNo, ticker, link)
+        form_4_filings = []
+        for filing in filings:
+            form_type = filing.get('formType', "")
+            ticker = filing.get('ticker', "")
+            company_name = filing.get('companyName', "")
+            accessionNo = filing.get('accessionNo', "")
 
-    except Exception as e:
-        print(f'Process Failed With the following Exception: {str(e)}')
+            if form_type in ["4", "4/A"] and accessionNo:
+                log.info("got a form type 4 trade for ticker %s with name %s",
+                         ticker, company_name)
+                form_4_filings.append(filing)
 
+        if form_4_filings:
+            # Call the fetch_insider_trades_batch coroutine
+            async with semaphore:
+                await fetch_insider_trades_batch(form_4_filings)
 
-async def send_ping(websocket):
-    while True:
-        try:
-            pong_waiter = await websocket.ping()
-            # Wait for a pong within 5 seconds
-            await asyncio.wait_for(pong_waiter, timeout=5)
-            await asyncio.sleep(30)  # Send ping every 30 seconds
-        except Exception as e:
-            print(f"An error occurred while sending ping: {e}")
-            await websocket.close()  # Close the connection if an error occurs
-            return
+    except Exception as e:
+        log.error("process failed: %s", e)
 
 
 async def main():
+    global insert_queue
+
+    listener = setup_logging()
     retry_counter = 0
     max_retries = 10
-    ping_task = None
+    semaphore = asyncio.Semaphore(FILINGS_CONCURRENCY)
+    insert_queue = asyncio.Queue()
+    flusher = asyncio.create_task(insert_flusher())
 
-    while retry_counter < max_retries:
-        try:
-            async with websockets.connect(WS_ENDPOINT) as websocket:
-                print("✅ Connected to:", SERVER_URL)
-                retry_counter = 0
-                # Start the ping/pong keep-alive routine
-                ping_task = asyncio.create_task(send_ping(websocket))
-                # Start the message-receiving loop
-                while True:
-                    message = await websocket.recv()
-                    filings = json.loads(message)
-                    for f in filings:
-                        await on_filings(f)
+    async with aiohttp.ClientSession() as session:
+        while retry_counter < max_retries:
+            try:
+                # heartbeat sends a ping every 30 seconds and closes the connection
+                # if the pong doesn't come back, replacing the manual ping task
+                async with session.ws_connect(WS_ENDPOINT, heartbeat=30, max_msg_size=0) as websocket:
+                    log.info("connected to %s", SERVER_URL)
+                    retry_counter = 0
+                    # Start the message-receiving loop
+                    async for message in websocket:
+                        if message.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                            filings = orjson.loads(message.data)
+                            # process the frame's filings in the background so a
+                            # slow one doesn't hold up receiving the next messages
+                            task = asyncio.create_task(
+                                on_filings(filings, semaphore))
+                            filing_tasks.add(task)
+                            task.add_done_callback(filing_tasks.discard)
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            raise websocket.exception()
 
-        except Exception as e:
-            retry_counter += 1
+                    raise ConnectionError(
+                        f"Server closed the connection with code {websocket.close_code}")
+
+            except Exception as e:
+                retry_counter += 1
 
-            print(f"Connection closed with message: {e}")
-            print(
-                f"Reconnecting in 5 sec... (Attempt {retry_counter}/{max_retries})")
+                log.warning("connection closed with message: %s", e)
+                log.warning("reconnecting in 5 sec... (attempt %d/%d)",
+                            retry_counter, max_retries)
 
-            # Cancel the ping task
-            if ping_task is not None:
-                try:
-                    ping_task.cancel()
-                    await ping_task
-                except Exception:
-                    pass  # Ignore any exceptions
-                ping_task = None
+                await asyncio.sleep(5)  # Wait for 5 seconds before reconnecting
 
-            await asyncio.sleep(5)  # Wait for 5 seconds before reconnecting
+    log.error("maximum reconnection attempts reached, stopping client")
 
-    print("Maximum reconnection attempts reached. Stopping client.")
+    # let the in-flight filings finish and insert whatever is still queued
+    await asyncio.gather(*filing_tasks, return_exceptions=True)
+    flusher.cancel()
+    await flush_inserts()
+    listener.stop()
 
-# Run the main coroutine
-asyncio.run(main())
+# Run the main coroutine on uvloop's libuv based event loop
+uvloop.run(main())
@@ -1,9 +1,10 @@
 import time
+import asyncio
 from celery import Celery
 from celery.schedules import crontab
 from app.internals.supabase_helper import get_trades_without_return, \
     update_trades_without_returns
-from app.internals.utils import calculate_returns
+from app.internals.utils import calculate_returns_batch
 from app.internals.resend_helper import daily_digest as d, \
     weekly_sector_report as w
 
@@ -17,48 +18,39 @@ celery = Celery(
 
 @celery.task(name="daily_digest")
 def daily_digest_task():
-    return d()
+    return asyncio.run(d())
 
 
 @celery.task(name="weekly_sector_report")
 def weekly_sector_report():
-    return w()
+    return asyncio.run(w())
+
+
+def run_returns(return_type):
+    """
+    Fill in the missing returns of `return_type` (see `get_trades_without_return`).
+    """
+    data = get_trades_without_return(return_type)
+    # the rows are only used for the upsert, fill the returns in place
+    for item, returns in zip(data, calculate_returns_batch(data)):
+        item.update(returns)
+    update_trades_without_returns(data)
+    return True
 
 
 @celery.task(name="weekly_returns")
 def weekly_returns():
-    data = get_trades_without_return("W")
-    final_data = [
-        {**item, **calculate_returns(item['ticker'], item['disclosed_date'],
-                                     item['total_shares'], item['share_price'])}
-        for item in data
-    ]
-    update_trades_without_returns(final_data)
-    return True
+    return run_returns("W")
 
 
 @celery.task(name="monthly_returns")
 def monthly_returns():
-    data = get_trades_without_return("M")
-    final_data = [
-        {**item, **calculate_returns(item['ticker'], item['disclosed_date'],
-                                     item['total_shares'], item['share_price'])}
-        for item in data
-    ]
-    update_trades_without_returns(final_data)
-    return True
+    return run_returns("M")
 
 
 @celery.task(name="semi_yearly_returns")
 def semi_yearly_returns():
-    data = get_trades_without_return("S")
-    final_data = [
-        {**item, **calculate_returns(item['ticker'], item['disclosed_date'],
-                                     item['total_shares'], item['share_price'])}
-        for item in data
-    ]
-    update_trades_without_returns(final_data)
-    return True
+    return run_returns("S")
 
 
 celery.conf.beat_schedule = {
@@ -70,13 +62,15 @@ celery.conf.beat_schedule = {
         'task': 'weekly_returns',
         'schedule': crontab(minute=0, hour=0),
     },
+    # staggered after the weekly returns so the three runs don't hit Yahoo
+    # Finance and Supabase at the same time
     'monthly-returns-daily-task': {
         'task': 'monthly_returns',
-        'schedule': crontab(minute=0, hour=0),
+        'schedule': crontab(minute=15, hour=0),
     },
     'semi-yearly-returns-daily-task': {
         'task': 'semi_yearly_returns',
-        'schedule': crontab(minute=0, hour=0),
+        'schedule': crontab(minute=30, hour=0),
     },
     'weekly-task': {
         'task': 'weekly_sector_report',